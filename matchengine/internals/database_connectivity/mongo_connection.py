@@ -55,16 +55,18 @@ class MongoDBConnection(object):
     db: Union[pymongo.database.Database, motor.motor_asyncio.AsyncIOMotorDatabase]
     client: Union[pymongo.MongoClient, motor.motor_asyncio.AsyncIOMotorClient]
 
-    def __init__(self, read_only=True, db=None, async_init=True):
+    def __init__(self, read_only=True, db=None, async_init=True, max_pool_size=None):
         """
         Default params to use values from an external SECRETS.JSON configuration file,
 
         Override SECRETS_JSON values if arguments are passed via CLI
         :param read_only:
         :param db:
+        :param max_pool_size: connection pool size to use if MONGO_MAX_POOL_SIZE is not set in SECRETS_JSON
         """
         self.read_only = read_only
         self.async_init = async_init
+        self.max_pool_size = max_pool_size
 
         if not hasattr(self, 'secrets'):
             self.secrets = DefaultDBSecrets().get_secrets()
@@ -80,6 +82,8 @@ class MongoDBConnection(object):
             uri_params.append(f"replicaSet={self.secrets.REPLICA_SET}")
         if self.secrets.MAX_POOL_SIZE:
             uri_params.append(f"maxPoolSize={self.secrets.MAX_POOL_SIZE}")
+        elif self.max_pool_size:
+            uri_params.append(f"maxPoolSize={self.max_pool_size}")
         if self.secrets.MIN_POOL_SIZE:
             uri_params.append(f"minPoolSize={self.secrets.MIN_POOL_SIZE}")
         username_password_param = (f"{username if username else str()}"
@@ -4,10 +4,12 @@ import asyncio
 import datetime
 import json
 import logging
+import multiprocessing
 import os
 import sys
 import uuid
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import cpu_count
 from typing import TYPE_CHECKING, Iterable, Tuple
 
@@ -25,6 +27,7 @@ from matchengine.internals.match_translator import (
 )
 from matchengine.internals.typing.matchengine_types import (
     PoisonPill,
+    POISON_PILL,
     Cache,
     QueryTask,
     UpdateTask,
@@ -93,6 +96,7 @@ class MatchEngine(object):
     _loop: asyncio.AbstractEventLoop
     _queue_task_count: int
     _workers: Dict[int, asyncio.Task]
+    _hash_pool: Union[ProcessPoolExecutor, None] = None
 
     def __enter__(self):
         return self
@@ -102,7 +106,7 @@ class MatchEngine(object):
         Ensure that all async workers exit gracefully.
         """
         for _ in range(0, self.num_workers):
-            self._task_q.put_nowait(PoisonPill())
+            self._task_q.put_nowait(POISON_PILL)
         await self._task_q.join()
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
@@ -117,6 +121,8 @@ class MatchEngine(object):
             self._loop.run_until_complete(self._async_exit())
             self._loop.stop()
             self._loop.close()
+        if self._hash_pool is not None:
+            self._hash_pool.shutdown()
 
     def __init__(
             self,
@@ -150,7 +156,8 @@ class MatchEngine(object):
             drop_accept: bool = False,
             resource_dirs: List = None,
             chunk_size: int = 1000,
-            bypass_warnings: bool = False
+            bypass_warnings: bool = False,
+            hash_workers: int = 0
     ):
         self.resource_dirs = list()
         self.resource_dirs.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'ref'))
@@ -168,6 +175,16 @@ class MatchEngine(object):
         self.chunk_size = chunk_size
         self.debug = debug
 
+        # hashing match documents is pure CPU work; optionally spread it over a pool of processes.
+        # Pool processes start lazily, after the mongo clients (and their monitor threads) exist, and pymongo isn't
+        # fork-safe, so they must not be forked from this process
+        if hash_workers > 0:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self._hash_pool = ProcessPoolExecutor(max_workers=hash_workers,
+                                                  mp_context=multiprocessing.get_context(start_method))
+        else:
+            self._hash_pool = None
+
         if config.__class__ is str:
             with open(config) as config_file_handle:
                 self.config = json.load(config_file_handle)
@@ -309,9 +326,14 @@ class MatchEngine(object):
         """
         # create a task queue for async tasks
         self._task_q = asyncio.queues.Queue()
-        self._async_db_ro = MongoDBConnection(read_only=True, db=db_name)
+        # A single client (and so a single connection pool) is shared by all workers. Each worker can have a couple
+        # of requests in flight at once (at most CLINICAL_PREFETCH_CONCURRENCY clinical id queries, or the
+        # clinical/extended document fetches in get_docs_results), so size the pool accordingly, but never below the
+        # driver's default of 100.
+        pool_size = max(self.num_workers * 2, 100)
+        self._async_db_ro = MongoDBConnection(read_only=True, db=db_name, max_pool_size=pool_size)
         self.async_db_ro = self._async_db_ro.__enter__()
-        self._async_db_rw = MongoDBConnection(read_only=False, db=db_name)
+        self._async_db_rw = MongoDBConnection(read_only=False, db=db_name, max_pool_size=pool_size)
         self.async_db_rw = self._async_db_rw.__enter__()
         # create "workers" which handle async tasks from the task_q
         # general pattern is to put a series of tasks in the queue, then await task_q.join()
@@ -366,14 +388,19 @@ class MatchEngine(object):
             extended_attribute_id_map = dict()
             all_match_reasons = clinical_match_reasons
 
-        needed_clinical = list(clinical_ids)
-        needed_extended = extended_attribute_id_map
+        # documents are the same for every query, so only fetch those which haven't been fetched already
+        docs = self.cache.docs
+        needed_clinical = [clinical_id for clinical_id in clinical_ids if docs.get(clinical_id) is None]
+        needed_extended = {
+            collection: [extended_id for extended_id in extended_ids if docs.get(extended_id) is None]
+            for collection, extended_ids in extended_attribute_id_map.items()
+        }
         results = await get_docs_results(self, needed_clinical, needed_extended)
 
         # asyncio.gather returns [[],[]]. Save the resulting values on the cache for use when creating trial matches
         for outer_result in results:
             for result in outer_result:
-                self.cache.docs[result["_id"]] = result
+                docs[result["_id"]] = result
 
         valid_reasons = get_valid_reasons(self, all_match_reasons, clinical_ids, extended_attribute_id_map)
 
@@ -388,13 +415,14 @@ class MatchEngine(object):
             task: Task = await self._task_q.get()
             args = (self, task, worker_id)
             task_class = task.__class__
-            if task_class is PoisonPill:
+            # query tasks make up nearly all of the queue, so are checked first
+            if task_class is QueryTask:
+                await run_query_task(*args)
+
+            elif task_class is PoisonPill:
                 await run_poison_pill(*args)
                 break
 
-            elif task_class is QueryTask:
-                await run_query_task(*args)
-
             elif task_class is UpdateTask:
                 await run_update_task(*args)
 
@@ -471,6 +499,17 @@ class MatchEngine(object):
         """
         Synchronously iterates over each protocol number, getting trial matches for each
         """
+        self._loop.run_until_complete(self._async_get_matches_for_all_trials())
+        return self._matches
+
+    async def _async_get_matches_for_all_trials(self):
+        """
+        Asynchronous function used by get_matches_for_all_trials, not meant to be called externally.
+        Queues the QueryTasks for every trial before waiting on any of them. Building the match trees and queries
+        for a trial is CPU bound, so this lets the workers run the queries of the trials already queued in the
+        meantime, instead of sitting idle until each trial has been fully translated.
+        """
+        queued_protocol_nos = list()
         for protocol_no in self.protocol_nos:
             if protocol_no not in self._trials_to_match_on:
                 logging.info((f'{self.match_criteria_transform.trial_collection} {protocol_no} '
@@ -479,14 +518,19 @@ class MatchEngine(object):
                 self._clinical_ids_for_protocol_cache[protocol_no] = self.get_clinical_ids_for_protocol(protocol_no,
                                                                                                         set())
                 continue
-            self.get_matches_for_trial(protocol_no)
-        return self._matches
+            if self._queue_matches_for_trial(protocol_no):
+                queued_protocol_nos.append(protocol_no)
+
+            # yield to the event loop so the workers can start on the tasks which were just queued
+            await asyncio.sleep(0)
+        await self._task_q.join()
+        for protocol_no in queued_protocol_nos:
+            self._log_match_totals(protocol_no)
 
     def get_matches_for_trial(self, protocol_no: str):
         """
         Get the trial matches for a given protocol number
         """
-        log.info(f"Begin {self.match_criteria_transform.trial_identifier}: {protocol_no}")
         task = self._loop.create_task(self._async_get_matches_for_trial(protocol_no))
         return self._loop.run_until_complete(task)
 
@@ -495,6 +539,19 @@ class MatchEngine(object):
         Asynchronous function used by get_matches_for_trial, not meant to be called externally.
         Gets the matches for a given trial
         """
+        if not self._queue_matches_for_trial(protocol_no):
+            return {}
+        await self._task_q.join()
+        self._log_match_totals(protocol_no)
+        return self._matches.get(protocol_no, dict())
+
+    def _queue_matches_for_trial(self, protocol_no: str) -> bool:
+        """
+        Translate each match path of a trial into queries, and put a QueryTask for each onto the task queue.
+        Returns False if the trial does not need to be run.
+        """
+        log.info(f"Begin {self.match_criteria_transform.trial_identifier}: {protocol_no}")
+
         # Get each match clause in the trial document
         trial = self.trials[protocol_no]
         match_clauses = extract_match_clauses_from_trial(self, protocol_no)
@@ -506,9 +563,11 @@ class MatchEngine(object):
             match_tree = create_match_tree(self, match_clause)
             match_paths = get_match_paths(match_tree)
 
-            # for each match path, translate the path into valid mongo queries
+            # for each match path, translate the path into valid mongo queries.
+            # paths of the same clause share criteria, so share translated query nodes between them
+            query_node_cache = dict()
             for match_path in match_paths:
-                query = translate_match_path(self, match_clause, match_path)
+                query = translate_match_path(self, match_clause, match_path, query_node_cache)
                 for criteria_node in match_path.criteria_list:
                     for criteria in criteria_node.criteria:
                         # check if node has any age criteria, to know to check for newly qualifying patients
@@ -526,19 +585,20 @@ class MatchEngine(object):
             self.create_run_log_entry(protocol_no, clinical_ids_to_run)
         if not clinical_ids_to_run:
             log.info(f"No need to re-run {self.match_criteria_transform.trial_collection} {protocol_no}; skipping")
-            return {}
+            return False
         for task in tasks:
             self._task_q.put_nowait(QueryTask(*task,
                                               clinical_ids_to_run))
         if self.debug:
-            log.info(f"Submitted {self._task_q.qsize()} QueryTasks to queue")
-        if not self._task_q.qsize():
+            log.info(f"Submitted {len(tasks)} QueryTasks to queue")
+        if not tasks:
             self._matches[protocol_no] = dict()
-        await self._task_q.join()
-        logging.info(f"Total patient matches: {len(self._matches.get(protocol_no, dict()))}")
+        return True
+
+    def _log_match_totals(self, protocol_no: str):
+        logging.info(f"Total patient matches for {protocol_no}: {len(self._matches.get(protocol_no, dict()))}")
         logging.info(
-            f"Total {self.trial_match_collection} documents: {sum([len(matches) for matches in self._matches.get(protocol_no, dict()).values()])}")
-        return self._matches.get(protocol_no, dict())
+            f"Total {self.trial_match_collection} documents for {protocol_no}: {sum([len(matches) for matches in self._matches.get(protocol_no, dict()).values()])}")
 
     def _populate_run_log_history(self) -> Dict[str, List[Dict]]:
         """
@@ -843,58 +903,71 @@ class MatchEngine(object):
                                 continue_matching_age = False
         return clinical_ids_to_run
 
-    def pre_process_trial_matches(self, trial_match: TrialMatch) -> Dict:
+    def pre_process_trial_matches(self, trial_match: TrialMatch, trial_match_base: Dict = None) -> Dict:
         """
-        Function which returns required fields for trial_match documents
+        Function which returns required fields for trial_match documents.
+
+        Fields which only depend on the trial and match path (see get_trial_match_base) are the same for every result
+        of a query, so can be computed once per query and passed in as trial_match_base.
         """
+        if trial_match_base is None:
+            trial_match_base = self.get_trial_match_base(trial_match)
 
         new_trial_match = dict()
         clinical_doc = self.cache.docs[trial_match.match_reason.clinical_id]
         new_trial_match.update(self.format_trial_match_k_v(clinical_doc))
-        new_trial_match['clinical_id'] = self.cache.docs[trial_match.match_reason.clinical_id][
-            '_id']
+        new_trial_match['clinical_id'] = clinical_doc['_id']
 
         new_trial_match.update(
             {
-                'match_level': trial_match.match_clause_data.match_clause_level,
-                'internal_id': trial_match.match_clause_data.internal_id,
                 'reason_type': trial_match.match_reason.reason_name,
                 'q_depth': trial_match.match_reason.depth,
                 'q_width': trial_match.match_reason.width,
-                'code': trial_match.match_clause_data.code,
-                'trial_curation_level_status': 'closed' if trial_match.match_clause_data.is_suspended else 'open',
-                'trial_summary_status': trial_match.match_clause_data.status,
-                'coordinating_center': trial_match.match_clause_data.coordinating_center,
                 'show_in_ui': trial_match.match_reason.show_in_ui,
-                'query_hash': trial_match.match_criterion.hash()
             })
+        new_trial_match.update(trial_match_base)
+
+        new_trial_match['is_disabled'] = False
+        new_trial_match.pop("_updated", None)
+        new_trial_match.pop("last_updated", None)
+        new_trial_match.pop("_id", None)
+        return new_trial_match
+
+    def get_trial_match_base(self, trial_match: TrialMatch) -> Dict:
+        """
+        Required fields for trial_match documents which are the same for every match reason on a match path
+        """
+        trial_match_base = {
+            'match_level': trial_match.match_clause_data.match_clause_level,
+            'internal_id': trial_match.match_clause_data.internal_id,
+            'code': trial_match.match_clause_data.code,
+            'trial_curation_level_status': 'closed' if trial_match.match_clause_data.is_suspended else 'open',
+            'trial_summary_status': trial_match.match_clause_data.status,
+            'coordinating_center': trial_match.match_clause_data.coordinating_center,
+            'query_hash': trial_match.match_criterion.hash()
+        }
 
         # add trial fields except for extras
-        new_trial_match.update({
+        trial_match_base.update({
             k: v
             for k, v in trial_match.trial.items()
             if k not in {'treatment_list', '_summary', 'status', '_elasticsearch', 'match'}
         })
 
-        new_trial_match.update(
+        trial_match_base.update(
             {
                 'match_path': '.'.join(
                     [str(item) for item in trial_match.match_clause_data.parent_path])
             })
 
-        new_trial_match['combo_coord'] = nested_object_hash(
+        trial_match_base['combo_coord'] = nested_object_hash(
             {
-                'query_hash': new_trial_match['query_hash'],
-                'match_path': new_trial_match['match_path'],
-                self.match_criteria_transform.trial_identifier: new_trial_match[
+                'query_hash': trial_match_base['query_hash'],
+                'match_path': trial_match_base['match_path'],
+                self.match_criteria_transform.trial_identifier: trial_match_base[
                     self.match_criteria_transform.trial_identifier]
             })
-
-        new_trial_match['is_disabled'] = False
-        new_trial_match.pop("_updated", None)
-        new_trial_match.pop("last_updated", None)
-        new_trial_match.pop("_id", None)
-        return new_trial_match
+        return trial_match_base
 
     def format_trial_match_k_v(self, clinical_doc):
         return {key.lower(): val for key, val in clinical_doc.items() if key != "_id"}
@@ -914,6 +987,10 @@ class MatchEngine(object):
     def loop(self):
         return self._loop
 
+    @property
+    def hash_pool(self):
+        return self._hash_pool
+
     @property
     def queue_task_count(self):
         return self._queue_task_count
@@ -52,6 +52,10 @@ class MatchCriteriaTransform(object):
     trial_identifier: str = None
     primary_collection_unique_field: str = "_id"
     ctml_collection_mappings: dict = None
+    id_projections: dict = None
+    trial_match_sorting: tuple = None
+    query_transformer_cache: dict = None
+    query_transformer_functions: dict = None
     level_mapping = {
         'dose_level': 'dose',
         'arm': 'arm',
@@ -82,7 +86,23 @@ class MatchCriteriaTransform(object):
         self.projections = {
             collection: {field: 1 for field in fields} for collection, fields in config["projections"].items()
         }
+        # projections used when querying a collection for the ids of documents matching a query
+        self.id_projections = {
+            query_level: {mapping['id_field']: 1, mapping['join_field']: 1}
+            for query_level, mapping in self.ctml_collection_mappings.items()
+            if 'id_field' in mapping and 'join_field' in mapping
+        }
+        # trial match sort order config, as (sort key, sort values, sort value for any value) for each sort dimension
+        self.trial_match_sorting = tuple(
+            tuple(
+                (sort_key, sorting_vals, sorting_vals.get("ANY_VALUE", None))
+                for sort_key, sorting_vals in sort_dimension.items()
+            )
+            for sort_dimension in config.get('trial_match_sorting', list())
+        )
         self.query_transformers = AllTransformersContainer(self)
+        self.query_transformer_cache = dict()
+        self.query_transformer_functions = dict()
         self.trial_collection = config.get('trial_collection', 'trial')
         self.trial_identifier = config.get('trial_identifier', 'protocol_no')
         self.match_trial_link_id = config.get('match_trial_link_id', self.trial_identifier)
@@ -2,6 +2,8 @@ from __future__ import annotations
 
 import logging
 from collections import deque
+from copy import deepcopy
+from functools import partial
 from itertools import cycle, chain
 from typing import TYPE_CHECKING
 
@@ -17,6 +19,7 @@ from matchengine.internals.typing.matchengine_types import (
     MatchCriterion,
     MultiCollectionQuery,
     QueryNode,
+    QueryPart,
     QueryTransformerResult,
     QueryNodeContainer
 )
@@ -26,7 +29,10 @@ if TYPE_CHECKING:
         Generator,
         Dict,
         Any,
-        Tuple
+        Callable,
+        List,
+        Tuple,
+        Union
     )
     from matchengine.internals.engine import MatchEngine
 
@@ -65,30 +71,32 @@ def extract_match_clauses_from_trial(matchengine: MatchEngine, protocol_no: str)
                                                 trial[matchengine.match_criteria_transform.trial_identifier])
             yield match_clause_data
         else:
-            process_q.append((tuple(), key, val))
+            process_q.append((None, key, val))
 
-    # process nested dicts to find more match clauses
+    # process nested dicts to find more match clauses.
+    # paths are kept as (parent path, key) pairs and only flattened into a tuple for match clauses
     while process_q:
         path, parent_key, parent_value = process_q.pop()
         if parent_value.__class__ is dict:
             for inner_key, inner_value in parent_value.items():
-                parent_path = ParentPath(path + (parent_key, inner_key))
-                # this funky logic is so that level/internal is None if node is not a match clause
-                level = MatchClauseLevel(
-                    matchengine.match_criteria_transform.level_mapping.get(
-                        next(
-                            chain(
-                                [item for item in parent_path[::-1] if item.__class__ is not int and item != 'match'],
-                                [None]
-                            )
-                        )))
-
-                internal_id = parent_value.get(
-                    matchengine.match_criteria_transform.internal_id_mapping.get(level, None), None)
-                code = parent_value.get(matchengine.match_criteria_transform.code_mapping.get(level, None), None)
                 if inner_key == 'match':
+                    parent_path = ParentPath(_flatten_path(path) + (parent_key, inner_key))
+                    # this funky logic is so that level/internal is None if node is not a match clause
+                    level = MatchClauseLevel(
+                        matchengine.match_criteria_transform.level_mapping.get(
+                            next(
+                                chain(
+                                    [item for item in parent_path[::-1]
+                                     if item.__class__ is not int and item != 'match'],
+                                    [None]
+                                )
+                            )))
+
+                    internal_id = parent_value.get(
+                        matchengine.match_criteria_transform.internal_id_mapping.get(level, None), None)
+                    code = parent_value.get(matchengine.match_criteria_transform.code_mapping.get(level, None), None)
                     is_suspended = False
-                    match_level = path[-1]
+                    match_level = path[1]
                     if match_level == 'step':
                         if all([arm.get('arm_suspended', 'n').lower().strip() == 'y'
                                 for arm in parent_value.get('arm', list())]):
@@ -120,10 +128,21 @@ def extract_match_clauses_from_trial(matchengine: MatchEngine, protocol_no: str)
                                           parent_value,
                                           trial[matchengine.match_criteria_transform.trial_identifier])
                 else:
-                    process_q.append((path + (parent_key,), inner_key, inner_value))
+                    process_q.append(((path, parent_key), inner_key, inner_value))
         elif parent_value.__class__ is list:
             for index, item in enumerate(parent_value):
-                process_q.append((path + (parent_key,), index, item))
+                process_q.append(((path, parent_key), index, item))
+
+
+def _flatten_path(path) -> tuple:
+    """
+    Turn a nested (parent path, key) pair, as built by extract_match_clauses_from_trial, into a flat tuple of keys
+    """
+    keys = list()
+    while path is not None:
+        path, key = path
+        keys.append(key)
+    return tuple(reversed(keys))
 
 
 def create_match_tree(matchengine, match_clause_data: MatchClauseData) -> MatchTree:
@@ -221,8 +240,7 @@ def create_match_tree(matchengine, match_clause_data: MatchClauseData) -> MatchT
                         successors = [
                             (successor, or_node_id)
                             for parent_or_node in parent_or_nodes
-                            for successor in nx.descendants(graph, parent_or_node)
-                            if graph.out_degree(successor) == 0
+                            for successor in _leaf_descendants(graph, parent_or_node)
                         ]
                         graph.add_edges_from(successors)
                 else:
@@ -248,88 +266,214 @@ def create_match_tree(matchengine, match_clause_data: MatchClauseData) -> MatchT
     return MatchTree(graph)
 
 
+def _leaf_descendants(graph: nx.DiGraph, node: NodeID) -> list:
+    """
+    Return all nodes reachable from node which have no successors (not including node itself)
+    """
+    succ = graph.succ
+    leaves = list()
+    seen = set()
+    stack = list(succ[node])
+    while stack:
+        current = stack.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        children = succ[current]
+        if children:
+            stack.extend(children)
+        else:
+            leaves.append(current)
+    return leaves
+
+
 def get_match_paths(match_tree: MatchTree) -> Generator[MatchCriterion]:
     """
     Takes a MatchTree (from create_match_tree) and yields the criteria from each possible path on the tree,
     from the root node to each leaf node
     """
-    leaves = list()
-    for node in match_tree.nodes:
-        if match_tree.out_degree(node) == 0:
-            leaves.append(node)
-    for leaf in leaves:
-        for path in nx.all_simple_paths(match_tree, 0, leaf) if leaf != 0 else [[leaf]]:
-            match_path = MatchCriterion(list())
-            for depth, node in enumerate(path):
-                if match_tree.nodes[node]['criteria_list']:
-                    match_path.add_criteria(MatchCriteria(match_tree.nodes[node]['criteria_list'], depth, node))
-            if match_path:
-                yield match_path
+    # the tree is a DAG (or-nodes can share children), so walk every root-to-leaf path in a single iterative DFS
+    # rather than searching from the root once per leaf. Paths are grouped by leaf, in node order, which keeps the
+    # order identical to running nx.all_simple_paths for each leaf in turn
+    succ = match_tree.succ
+    paths_by_leaf: Dict[NodeID, list] = {node: list() for node in match_tree.nodes if not succ[node]}
+    stack = [(0, (0,))]
+    while stack:
+        node, path = stack.pop()
+        children = succ[node]
+        if not children:
+            paths_by_leaf[node].append(path)
+            continue
+        stack.extend((child, path + (child,)) for child in reversed(list(children)))
+    # paths share most of their nodes, so criteria are shared between paths (see MatchCriteria.hash_strings)
+    match_criteria: Dict[Tuple[NodeID, int], MatchCriteria] = dict()
+    for path in chain.from_iterable(paths_by_leaf.values()):
+        match_path = MatchCriterion(list())
+        for depth, node in enumerate(path):
+            if match_tree.nodes[node]['criteria_list']:
+                criteria = match_criteria.get((node, depth))
+                if criteria is None:
+                    criteria = match_criteria[(node, depth)] = MatchCriteria(match_tree.nodes[node]['criteria_list'],
+                                                                             depth,
+                                                                             node)
+                match_path.add_criteria(criteria)
+        if match_path:
+            yield match_path
+
+
+def get_query_transformer(matchengine, node_name: str, trial_key: str) -> Union[Callable, None]:
+    """
+    Return the query transformer configured for a trial key, with every argument other than the trial value and
+    parent path already bound, or None if the trial key is ignored.
+    Built once per node name/trial key, rather than looking up the trial key's settings for every criteria.
+    """
+    match_criteria_transform = matchengine.match_criteria_transform
+    query_transformer_functions = match_criteria_transform.query_transformer_functions
+    function_key = (node_name, trial_key)
+    if function_key not in query_transformer_functions:
+        trial_key_mappings = match_criteria_transform.ctml_collection_mappings[node_name]['trial_key_mappings']
+        trial_key_settings = trial_key_mappings.get(trial_key.upper(), dict())
+        if trial_key_settings.get('ignore', False):
+            query_transformer_functions[function_key] = None
+        else:
+            sample_value_function_name = trial_key_settings.get('sample_value', 'nomap')
+            sample_function = getattr(match_criteria_transform.query_transformers, sample_value_function_name)
+            sample_function_args = dict(sample_key=trial_key.upper(),
+                                        trial_path=node_name,
+                                        trial_key=trial_key)
+            sample_function_args.update(trial_key_settings)
+            query_transformer_functions[function_key] = partial(sample_function, **sample_function_args)
+    return query_transformer_functions[function_key]
+
+
+def run_query_transformer(matchengine,
+                          sample_function: Callable,
+                          node_name: str,
+                          trial_key: str,
+                          trial_value: Any,
+                          parent_path: ParentPath) -> QueryTransformerResult:
+    """
+    Run the query transformer for a trial key (see get_query_transformer) on a trial value.
+    The same criteria are curated across many arms/trials, so results are memoized on the inputs that determine them;
+    a fresh (deep) copy of each query part is returned as query parts, and the values in their queries, may be mutated
+    further down the line by node transformers and plugins.
+    Copies carry the hash of the memoized query part, so a query is only hashed once however often it is curated.
+    """
+    match_criteria_transform = matchengine.match_criteria_transform
+    # the class is part of the key as 1, 1.0 and True are equal (and hash the same) but give different queries
+    cache_key = (node_name, trial_key, trial_value.__class__, trial_value, parent_path)
+    try:
+        cached_result = match_criteria_transform.query_transformer_cache.get(cache_key)
+    except TypeError:
+        # unhashable trial value (e.g. a list), not cached
+        cache_key = cached_result = None
+
+    if cached_result is None:
+        cached_result: QueryTransformerResult = sample_function(trial_value=trial_value, parent_path=parent_path)
+        if cache_key is not None:
+            match_criteria_transform.query_transformer_cache[cache_key] = cached_result
+
+    result = QueryTransformerResult.empty()
+    result.results.extend(QueryPart(deepcopy(query_part.query),
+                                    query_part.negate,
+                                    query_part.render,
+                                    query_part.mcq_invalidating,
+                                    query_part.hash())
+                          for query_part in cached_result.results)
+    return result
+
+
+def translate_criteria(matchengine,
+                       match_clause_data: MatchClauseData,
+                       node: MatchCriteria,
+                       criteria: Dict[str, Any],
+                       node_name: str,
+                       values: Dict[str, Any]) -> List[QueryNode]:
+    """
+    Translate a single criteria from a node on a match path into finalized query nodes.
+    """
+    initial_query_node = QueryNode(node_name, node.node_id, criteria, node.depth, list(), None)
+    query_nodes = list()
+    query_nodes.append(initial_query_node)
+    for trial_key, trial_value in values.items():
+        sample_function = get_query_transformer(matchengine, node_name, trial_key)
+        if sample_function is None:
+            continue
+
+        result = run_query_transformer(matchengine,
+                                       sample_function,
+                                       node_name,
+                                       trial_key,
+                                       trial_value,
+                                       match_clause_data.parent_path)
+        to_create = len(result.results) - 1
+        created_nodes = [query_node.__copy__()
+                         for _
+                         in range(0, to_create)
+                         for query_node
+                         in query_nodes]
+        for initial_query_node in query_nodes:
+            query_part = result.results[0]
+            initial_query_node.add_query_part(query_part)
+        for new_query_node, query_part in zip(created_nodes, cycle(result.results[1::])):
+            new_query_node.add_query_part(query_part)
+            query_nodes.append(new_query_node)
+        for query_node in query_nodes:
+            query_node.exclusion = (True
+                                    if (query_node.query_parts[-1].negate
+                                        or query_node.exclusion)
+                                    else False)
+    translated_query_nodes = list()
+    sibling_nodes = len(query_nodes)
+    for query_node in query_nodes:
+        if query_node.exclusion is not None:
+            query_node.sibling_nodes = sibling_nodes
+            matchengine.query_node_transform(query_node)
+            query_node.finalize()
+            translated_query_nodes.append(query_node)
+    return translated_query_nodes
 
 
 def translate_match_path(matchengine,
                          match_clause_data: MatchClauseData,
-                         match_criterion: MatchCriterion) -> MultiCollectionQuery:
+                         match_criterion: MatchCriterion,
+                         query_node_cache: Dict = None) -> MultiCollectionQuery:
     """
     Translate the keys/values from the trial curation into keys/values used in a extended_attributes/clinical document.
     Uses an external config file ./config/config.json
 
+    The match paths of a match clause share most of their criteria. If a dict is passed as query_node_cache when
+    translating each path of a clause, the query nodes translated for a criteria are reused across paths, so the same
+    query node objects can end up in several queries and must not be modified once translated.
     """
     multi_collection_query = MultiCollectionQuery(list(), list())
     query_cache = set()
     for node in match_criterion.criteria_list:
         for criteria in node.criteria:
             for node_name, values in criteria.items():
-                trial_key_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[node_name][
-                    'trial_key_mappings']
-                initial_query_node = QueryNode(node_name, node.node_id, criteria, node.depth, list(), None)
-                query_nodes = list()
-                query_nodes.append(initial_query_node)
-                for trial_key, trial_value in values.items():
-                    trial_key_settings = trial_key_mappings.get(trial_key.upper(), dict())
-
-                    if trial_key_settings.get('ignore', False):
-                        continue
-
-                    sample_value_function_name = trial_key_settings.get('sample_value', 'nomap')
-                    sample_function = getattr(matchengine.match_criteria_transform.query_transformers,
-                                              sample_value_function_name)
-                    sample_function_args = dict(sample_key=trial_key.upper(),
-                                                trial_value=trial_value,
-                                                parent_path=match_clause_data.parent_path,
-                                                trial_path=node_name,
-                                                trial_key=trial_key)
-                    sample_function_args.update(trial_key_settings)
-                    result: QueryTransformerResult = sample_function(**sample_function_args)
-                    to_create = len(result.results) - 1
-                    created_nodes = [query_node.__copy__()
-                                     for _
-                                     in range(0, to_create)
-                                     for query_node
-                                     in query_nodes]
-                    for initial_query_node in query_nodes:
-                        query_part = result.results[0]
-                        initial_query_node.add_query_part(query_part)
-                    for new_query_node, query_part in zip(created_nodes, cycle(result.results[1::])):
-                        new_query_node.add_query_part(query_part)
-                        query_nodes.append(new_query_node)
-                    for query_node in query_nodes:
-                        query_node.exclusion = (True
-                                                if (query_node.query_parts[-1].negate
-                                                    or query_node.exclusion)
-                                                else False)
+                # criteria are the dicts from the match clause itself, so identity is only shared between paths
+                # passing through the same node of the match tree
+                cache_key = (node_name, id(criteria), node.node_id, node.depth)
+                if query_node_cache is not None and cache_key in query_node_cache:
+                    translated_query_nodes = query_node_cache[cache_key]
+                else:
+                    translated_query_nodes = translate_criteria(matchengine,
+                                                                match_clause_data,
+                                                                node,
+                                                                criteria,
+                                                                node_name,
+                                                                values)
+                    if query_node_cache is not None:
+                        query_node_cache[cache_key] = translated_query_nodes
                 query_node_container = QueryNodeContainer(list())
-                sibling_nodes = len(query_nodes)
-                for query_node in query_nodes:
-                    if query_node.exclusion is not None:
-                        query_node.sibling_nodes = sibling_nodes
-                        matchengine.query_node_transform(query_node)
-                        query_node.finalize()
-                        query_node_hash = query_node.hash()
-                        if query_node_hash not in query_cache:
-                            query_cache.add(query_node_hash)
-                            query_node_container.query_nodes.append(query_node)
+                for query_node in translated_query_nodes:
+                    query_node_hash = query_node.hash()
+                    if query_node_hash not in query_cache:
+                        query_cache.add(query_node_hash)
+                        query_node_container.query_nodes.append(query_node)
                 matchengine.query_node_container_transform(query_node_container)
-                node_type = 'clinical' if node_name == 'clinical' else 'extended_attributes'
-                getattr(multi_collection_query, node_type).append(query_node_container)
+                if node_name == 'clinical':
+                    multi_collection_query.clinical.append(query_node_container)
+                else:
+                    multi_collection_query.extended_attributes.append(query_node_container)
     return multi_collection_query
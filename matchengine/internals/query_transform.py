@@ -32,6 +32,9 @@ def attach_transformers_to_match_criteria_transform(match_criteria_transform: Ma
             setattr(match_criteria_transform.query_transformers,
                     attr,
                     MethodType(method, match_criteria_transform.query_transformers))
+    # functions and results from previously attached transformers may no longer be valid
+    match_criteria_transform.query_transformer_functions.clear()
+    match_criteria_transform.query_transformer_cache.clear()
 
 
 class BaseTransformers(QueryTransformerContainer):
@@ -57,7 +60,7 @@ class BaseTransformers(QueryTransformerContainer):
         months = round(months_fraction * 12)
         query_date = current_date + (- relativedelta(years=years, months=months))
         query_datetime = datetime.datetime(query_date.year, query_date.month, query_date.day, query_date.hour, 0, 0, 0)
-        return QueryTransformerResult({sample_key: {operator_map[operator]: query_datetime}}, False)
+        return QueryTransformerResult.of({sample_key: {operator_map[operator]: query_datetime}}, False)
 
     def age_range_to_date_int_query(self, **kwargs):
         sample_key = kwargs['sample_key']
@@ -80,7 +83,8 @@ class BaseTransformers(QueryTransformerContainer):
         months_fraction = float('0.' + split_time[1]) if len(split_time) > 1 else 0
         months = round(months_fraction * 12)
         query_date = current_date + (- relativedelta(years=years, months=months))
-        return QueryTransformerResult({sample_key: {operator_map[operator]: int(query_date.strftime('%Y%m%d'))}}, False)
+        return QueryTransformerResult.of({sample_key: {operator_map[operator]: int(query_date.strftime('%Y%m%d'))}},
+                                         False)
 
     def nomap(self, **kwargs):
         trial_path = kwargs['trial_path']
@@ -88,7 +92,7 @@ class BaseTransformers(QueryTransformerContainer):
         trial_value = kwargs['trial_value']
         sample_key = kwargs['sample_key']
         trial_value, negate = is_negate(trial_value)
-        return QueryTransformerResult({sample_key: trial_value}, negate)
+        return QueryTransformerResult.of({sample_key: trial_value}, negate)
 
     def external_file_mapping(self, **kwargs):
         trial_value = kwargs['trial_value']
@@ -101,15 +105,15 @@ class BaseTransformers(QueryTransformerContainer):
         trial_value, negate = is_negate(trial_value)
         match_value = resource.setdefault(trial_value, trial_value)
         if match_value.__class__ is list:
-            return QueryTransformerResult({sample_key: {"$in": sorted(match_value)}}, negate)
+            return QueryTransformerResult.of({sample_key: {"$in": sorted(match_value)}}, negate)
         else:
-            return QueryTransformerResult({sample_key: match_value}, negate)
+            return QueryTransformerResult.of({sample_key: match_value}, negate)
 
     def to_upper(self, **kwargs):
         trial_value = kwargs['trial_value']
         sample_key = kwargs['sample_key']
         trial_value, negate = is_negate(trial_value)
-        return QueryTransformerResult({sample_key: trial_value.upper()}, negate)
+        return QueryTransformerResult.of({sample_key: trial_value.upper()}, negate)
 
 
 __export__ = ["BaseTransformers"]
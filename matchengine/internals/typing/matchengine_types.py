@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import copy
 import datetime
-from itertools import chain
+import hashlib
 from typing import (
     NewType,
     Tuple,
@@ -16,7 +16,11 @@ from typing import (
 from bson import ObjectId
 from networkx import DiGraph
 
-from matchengine.internals.utilities.object_comparison import nested_object_hash
+from matchengine.internals.utilities.object_comparison import (
+    nested_object_hash,
+    nested_object_strings,
+    hash_object_strings
+)
 
 Trial = NewType("Trial", dict)
 ParentPath = NewType("ParentPath", Tuple[Union[str, int]])
@@ -35,13 +39,22 @@ class PoisonPill(object):
     __slots__ = ()
 
 
+# poison pills carry no state, so the same instance is put on the queue for every worker
+POISON_PILL = PoisonPill()
+
+
 class CheckIndicesTask(object):
-    __slots__ = ()
+    __slots__ = (
+        "retries",
+    )
+
+    def __init__(self):
+        self.retries = 0
 
 
 class IndexUpdateTask(object):
     __slots__ = (
-        "collection", "index"
+        "collection", "index", "retries"
     )
 
     def __init__(
@@ -51,12 +64,13 @@ class IndexUpdateTask(object):
     ):
         self.index = index
         self.collection = collection
+        self.retries = 0
 
 
 class QueryTask(object):
     __slots__ = (
         "trial", "match_clause_data", "match_path",
-        "query", "clinical_ids"
+        "query", "clinical_ids", "retries"
     )
 
     def __init__(
@@ -72,11 +86,12 @@ class QueryTask(object):
         self.match_path = match_path
         self.match_clause_data = match_clause_data
         self.trial = trial
+        self.retries = 0
 
 
 class UpdateTask(object):
     __slots__ = (
-        "ops", "protocol_no"
+        "ops", "protocol_no", "retries"
     )
 
     def __init__(
@@ -86,11 +101,12 @@ class UpdateTask(object):
     ):
         self.ops = ops
         self.protocol_no = protocol_no
+        self.retries = 0
 
 
 class RunLogUpdateTask(object):
     __slots__ = (
-        "protocol_no"
+        "protocol_no", "retries"
     )
 
     def __init__(
@@ -98,6 +114,7 @@ class RunLogUpdateTask(object):
             protocol_no: str
     ):
         self.protocol_no = protocol_no
+        self.retries = 0
 
 
 Task = NewType("Task", Union[PoisonPill, CheckIndicesTask, IndexUpdateTask, QueryTask, UpdateTask, RunLogUpdateTask])
@@ -105,7 +122,8 @@ Task = NewType("Task", Union[PoisonPill, CheckIndicesTask, IndexUpdateTask, Quer
 
 class MatchCriteria(object):
     __slots__ = (
-        "criteria", "depth", "node_id"
+        "criteria", "depth", "node_id",
+        "_hash_strings"
     )
 
     def __init__(
@@ -117,6 +135,16 @@ class MatchCriteria(object):
         self.criteria = criteria
         self.depth = depth
         self.node_id = node_id
+        self._hash_strings = None
+
+    def hash_strings(self) -> List[str]:
+        """
+        The strings hashed for these criteria by MatchCriterion.hash. Kept so that match paths sharing criteria from
+        the same node of the match tree only walk them once
+        """
+        if self._hash_strings is None:
+            self._hash_strings = nested_object_strings(self.criteria, ("query", None))
+        return self._hash_strings
 
 
 class MatchCriterion(object):
@@ -137,7 +165,10 @@ class MatchCriterion(object):
 
     def hash(self) -> str:
         if self._hash is None:
-            self._hash = nested_object_hash({"query": [criteria.criteria for criteria in self.criteria_list]})
+            # same digest as nested_object_hash({"query": [criteria.criteria for criteria in self.criteria_list]})
+            self._hash = hash_object_strings([hash_string
+                                              for criteria in self.criteria_list
+                                              for hash_string in criteria.hash_strings()])
         return self._hash
 
 
@@ -171,28 +202,35 @@ class QueryPart(object):
             key,
             value
     ):
+        self._hash = None
         self._query[key] = value
 
     def __copy__(self):
-        return QueryPart(
-            self.query,
-            self.negate,
-            self.render,
-            self.mcq_invalidating,
-            self._hash
-        )
+        # query parts are copied for every query node created by a query transformer, so skip __init__
+        query_part = QueryPart.__new__(QueryPart)
+        query_part.mcq_invalidating = self.mcq_invalidating
+        query_part.render = self.render
+        query_part.negate = self.negate
+        query_part._query = self._query
+        query_part._hash = self._hash
+        return query_part
 
     @property
     def query(self):
         return self._query
 
+    def __repr__(self):
+        # kept short and free of hashing, as query parts end up in log messages
+        return f"<QueryPart keys={list(self._query)} negate={self.negate} render={self.render}>"
+
 
 class QueryNode(object):
     __slots__ = (
         "query_level", "query_depth", "query_parts",
         "exclusion", "is_finalized", "_hash",
         "_raw_query", "_raw_query_hash", "sibling_nodes",
-        "node_id", "criterion_ancestor"
+        "node_id", "criterion_ancestor", "_mcq_invalidating",
+        "_key_index"
     )
 
     def __init__(
@@ -201,7 +239,7 @@ class QueryNode(object):
             node_id: int,
             criterion_ancestor: MatchCriteria,
             query_depth: int,
-            query_parts: List[QueryPart],
+            query_parts: Union[List[QueryPart], Tuple[QueryPart, ...]],
             exclusion: Union[None, bool] = None,
             is_finalized: bool = False,
             _hash: str = None,
@@ -219,18 +257,23 @@ class QueryNode(object):
         self._hash = _hash
         self._raw_query = _raw_query
         self._raw_query_hash = _raw_query_hash
+        self._mcq_invalidating = None
+        self._key_index = None
         self.sibling_nodes = None
 
     def hash(self) -> str:
         if self._hash is None:
-            self._hash = nested_object_hash({
-                "_tmp1": [query_part.hash()
-                          for query_part in self.query_parts],
-                '_tmp2': self.exclusion
-            })
+            # query part hashes are fixed-length hex digests, so can be combined by concatenation rather than
+            # re-hashing a wrapping object. They are sorted so that the order of the query parts doesn't matter
+            self._hash = hashlib.sha1(
+                ''.join(sorted(query_part.hash() for query_part in self.query_parts)).encode()
+                + str(self.exclusion).encode()
+            ).hexdigest()
         return self._hash
 
     def add_query_part(self, query_part: QueryPart):
+        if self.is_finalized:
+            raise Exception("Query node is finalized")
         self._hash = None
         self._raw_query = None
         self._raw_query_hash = None
@@ -246,8 +289,6 @@ class QueryNode(object):
 
     def extract_raw_query(self):
         if self.is_finalized:
-            if self._raw_query is None:
-                self._raw_query = self._extract_raw_query()
             return self._raw_query
         else:
             return self._extract_raw_query()
@@ -261,43 +302,73 @@ class QueryNode(object):
         return self._raw_query_hash
 
     def finalize(self):
+        """
+        Freeze the query node. The raw query, key index and hashes are built from the query parts as they are now,
+        so the parts of a finalized node must not be changed (e.g. gain keys through set_query_attr) afterwards.
+        """
+        self.query_parts = tuple(self.query_parts)
+        # raw queries are read for every query run and match document created from the node, so build them once here
+        self._raw_query = self._extract_raw_query()
+        self._mcq_invalidating = any(query_part.mcq_invalidating for query_part in self.query_parts)
+        self._key_index = self._build_key_index()
         self.is_finalized = True
 
+    def _build_key_index(self) -> Dict[str, QueryPart]:
+        # first query part containing each key, as found by get_query_part_by_key
+        key_index = dict()
+        for query_part in self.query_parts:
+            for key in query_part.query:
+                key_index.setdefault(key, query_part)
+        return key_index
+
     def get_query_part_by_key(self, key: str) -> QueryPart:
-        return next(chain((query_part
-                           for query_part in self.query_parts
-                           if key in query_part.query),
-                          iter([None])))
+        if self.is_finalized:
+            return self._key_index.get(key)
+        for query_part in self.query_parts:
+            if key in query_part.query:
+                return query_part
+        return None
 
     def get_query_part_value_by_key(self, key: str, default: Any = None) -> Any:
         query_part = self.get_query_part_by_key(key)
         if query_part is not None:
             return query_part.query.get(key, default)
+        return default
 
     @property
     def mcq_invalidating(self):
-        return True if any([query_part.mcq_invalidating for query_part in self.query_parts]) else False
+        if self.is_finalized:
+            return self._mcq_invalidating
+        return any(query_part.mcq_invalidating for query_part in self.query_parts)
 
     def __copy__(self):
-        return QueryNode(
-            self.query_level,
-            self.node_id,
-            self.criterion_ancestor,
-            self.query_depth,
-            [query_part.__copy__()
-             for query_part
-             in self.query_parts],
-            self.exclusion,
-            self.is_finalized,
-            self._hash,
-            self._raw_query,
-            self._raw_query_hash
-        )
+        query_parts = [query_part.__copy__()
+                       for query_part
+                       in self.query_parts]
+        query_node = QueryNode.__new__(QueryNode)
+        query_node.node_id = self.node_id
+        query_node.criterion_ancestor = self.criterion_ancestor
+        query_node.is_finalized = self.is_finalized
+        query_node.query_level = self.query_level
+        query_node.query_depth = self.query_depth
+        query_node.query_parts = tuple(query_parts) if self.is_finalized else query_parts
+        query_node.exclusion = self.exclusion
+        query_node._hash = self._hash
+        query_node._raw_query = self._raw_query
+        query_node._raw_query_hash = self._raw_query_hash
+        query_node._mcq_invalidating = self._mcq_invalidating
+        query_node._key_index = query_node._build_key_index() if self.is_finalized else None
+        query_node.sibling_nodes = None
+        return query_node
+
+    def __repr__(self):
+        return (f"<QueryNode {self.query_level} node_id={self.node_id} depth={self.query_depth} "
+                f"parts={len(self.query_parts)} exclusion={self.exclusion} finalized={self.is_finalized}>")
 
 
 class QueryNodeContainer(object):
     __slots__ = (
-        "query_nodes"
+        "query_nodes",
     )
 
     def __init__(
@@ -372,8 +443,7 @@ class MatchClauseData(object):
 class ExtendedMatchReason(object):
     __slots__ = (
         "query_node", "width", "clinical_id",
-        "reference_id", "clinical_width", "depth",
-        "show_in_ui", "reason_name"
+        "reference_id", "clinical_width", "show_in_ui"
     )
 
     def __init__(
@@ -391,8 +461,14 @@ class ExtendedMatchReason(object):
         self.clinical_id = clinical_id
         self.width = width
         self.query_node = query_node
-        self.depth = query_node.query_depth
-        self.reason_name = query_node.query_level
+
+    @property
+    def depth(self):
+        return self.query_node.query_depth
+
+    @property
+    def reason_name(self):
+        return self.query_node.query_level
 
     def extract_raw_query(self):
         return self.query_node.extract_raw_query()
@@ -428,7 +504,7 @@ MatchReason = NewType("MatchReason", Union[ExtendedMatchReason, ClinicalMatchRea
 class TrialMatch(object):
     __slots__ = (
         "trial", "match_clause_data", "match_criterion",
-        "match_clause_data", "multi_collection_query", "match_reason",
+        "multi_collection_query", "match_reason",
         "run_log"
     )
 
@@ -500,7 +576,7 @@ class Secrets(object):
 
 class QueryTransformerResult(object):
     __slots__ = (
-        "results"
+        "results",
     )
     results: List[QueryPart]
 
@@ -519,6 +595,24 @@ class QueryTransformerResult(object):
                 raise Exception("If adding query result directly to results container, "
                                 "both Negate and Query must be specified")
 
+    @classmethod
+    def empty(cls) -> QueryTransformerResult:
+        query_transformer_result = cls.__new__(cls)
+        query_transformer_result.results = list()
+        return query_transformer_result
+
+    @classmethod
+    def of(
+            cls,
+            query_clause: Dict,
+            negate: bool,
+            render: bool = True,
+            mcq_invalidating: bool = False
+    ) -> QueryTransformerResult:
+        query_transformer_result = cls.__new__(cls)
+        query_transformer_result.results = [QueryPart(query_clause, negate, render, mcq_invalidating)]
+        return query_transformer_result
+
     def add_result(
             self,
             query_clause: Dict,
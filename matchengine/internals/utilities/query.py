@@ -5,7 +5,7 @@ import logging
 import operator
 from collections import defaultdict
 from functools import reduce
-from typing import TYPE_CHECKING, Dict
+from typing import TYPE_CHECKING, Dict, Any, Awaitable, Callable
 
 from matchengine.internals.typing.matchengine_types import (
     ClinicalMatchReason,
@@ -20,7 +20,9 @@ if TYPE_CHECKING:
     from matchengine.internals.engine import MatchEngine
     from matchengine.internals.typing.matchengine_types import (
         ClinicalID,
-        MultiCollectionQuery
+        MultiCollectionQuery,
+        QueryNode,
+        QueryPart
     )
     from typing import (
         Tuple,
@@ -31,6 +33,11 @@ if TYPE_CHECKING:
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('matchengine')
 
+# id queries only return a couple of small fields per document, so fetch them in large batches
+ID_QUERY_BATCH_SIZE = 10000
+# how many clinical id queries a single query task prefetches at once
+CLINICAL_PREFETCH_CONCURRENCY = 2
+
 
 async def execute_clinical_queries(matchengine: MatchEngine,
                                    multi_collection_query: MultiCollectionQuery,
@@ -46,12 +53,12 @@ async def execute_clinical_queries(matchengine: MatchEngine,
     reasons = defaultdict(list)
     reasons_cache = set()
     query_parts_by_hash = dict()
+
+    # Issue the clinical queries up front so the round-trips to the db overlap rather than being awaited one after
+    # another. The results are saved on the cache, so the subsetting below is then done (almost) entirely in memory.
+    await prefetch_clinical_query_parts(matchengine, multi_collection_query, clinical_ids)
     for _clinical in multi_collection_query.clinical:
         for query_node in _clinical.query_nodes:
-            query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_node.query_level]
-            collection = query_level_mappings["query_collection"]
-            join_field = query_level_mappings["join_field"]
-            id_field = query_level_mappings["id_field"]
             show_in_ui, clinical_ids = matchengine.clinical_query_node_clinical_ids_subsetter(query_node, clinical_ids)
             for query_part in query_node.query_parts:
                 if not query_part.render:
@@ -60,38 +67,15 @@ async def execute_clinical_queries(matchengine: MatchEngine,
                 query_parts_by_hash[query_part.hash()] = query_part
                 # hash the inner query to use as a reference for returned clinical ids, if necessary
                 query_hash = query_part.hash()
-                if query_hash not in matchengine.cache.ids:
-                    matchengine.cache.ids[query_hash] = dict()
-
-                # create a nested id_cache where the key is the clinical ID being queried and the vals
-                # are the clinical IDs returned
-                id_cache = matchengine.cache.ids[query_hash]
-                queried_ids = set(id_cache.keys())
-                still_waiting_for = matchengine.cache.in_process.setdefault(query_hash, set())
-                need_new = clinical_ids - queried_ids - still_waiting_for
-                matchengine.cache.in_process.setdefault(query_hash, set()).update(need_new)
-
-                if need_new:
-                    new_query = {'$and': [{join_field: {'$in': list(need_new)}}, query_part.query]}
-                    if matchengine.debug:
-                        log.info(f"{query_part.query}")
-                    projection = {id_field: 1, join_field: 1}
-                    docs = await matchengine.async_db_ro[collection].find(new_query, projection).to_list(None)
-
-                    # save returned ids
-                    for doc in docs:
-                        id_cache[doc[id_field]] = doc[join_field]
-
-                    # save IDs NOT returned as None so if a query is run in the future which is the same, it will skip
-                    for unfound in need_new - set(id_cache.keys()):
-                        id_cache[unfound] = None
-                    matchengine.cache.in_process[query_hash].difference_update(need_new)
-
-                while True:
-                    still_waiting_for.intersection_update(matchengine.cache.in_process[query_hash])
-                    if not still_waiting_for:
-                        break
-                    await asyncio.sleep(0.01)
+
+                # fetch any ids not covered by the up front queries, e.g. if a subsetter plugin returned new ids,
+                # and wait for those being fetched by other tasks
+                id_cache = await fetch_query_ids(
+                    matchengine,
+                    query_hash,
+                    clinical_ids,
+                    lambda: fetch_clinical_query_part(matchengine, query_node, query_part, clinical_ids)
+                )
                 for clinical_id in list(clinical_ids):
 
                     # an exclusion criteria returned a clinical document hence doc is not a match
@@ -120,6 +104,168 @@ async def execute_clinical_queries(matchengine: MatchEngine,
     return clinical_ids, reasons
 
 
+async def prefetch_clinical_query_parts(matchengine: MatchEngine,
+                                        multi_collection_query: MultiCollectionQuery,
+                                        clinical_ids: Set[ClinicalID]):
+    """
+    Fetch the ids for every rendered clinical query part of a query, with at most CLINICAL_PREFETCH_CONCURRENCY
+    queries in flight at once.
+
+    Each part is queried for all of clinical_ids, rather than only those left after the preceding parts, so this
+    trades some extra query volume for fewer sequential round trips. If a query fails, the others are cancelled (which
+    releases their ids, see fetch_clinical_query_part) before the error is raised.
+    """
+    semaphore = asyncio.Semaphore(CLINICAL_PREFETCH_CONCURRENCY)
+
+    async def fetch(query_node: QueryNode, query_part: QueryPart):
+        async with semaphore:
+            await fetch_clinical_query_part(matchengine, query_node, query_part, clinical_ids)
+
+    tasks = [
+        asyncio.ensure_future(fetch(query_node, query_part))
+        for _clinical in multi_collection_query.clinical
+        for query_node in _clinical.query_nodes
+        for query_part in query_node.query_parts
+        if query_part.render
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def fetch_query_ids(matchengine: MatchEngine,
+                          query_hash: str,
+                          clinical_ids: Set[ClinicalID],
+                          fetch: Callable[[], Awaitable]) -> Dict[ClinicalID, Any]:
+    """
+    Run fetch (one of fetch_clinical_query_part or fetch_extended_query_node) until every one of clinical_ids is on the
+    id cache for query_hash, and return the id cache.
+
+    Ids which are being fetched by another task are waited on. If that fetch fails, the ids are released without being
+    cached and are fetched by the next call to fetch here.
+    """
+    id_cache = matchengine.cache.ids.setdefault(query_hash, dict())
+    in_process = matchengine.cache.in_process.setdefault(query_hash, set())
+    while True:
+        await fetch()
+        pending = {clinical_id for clinical_id in clinical_ids if clinical_id not in id_cache}
+        if not pending:
+            return id_cache
+        while not pending.isdisjoint(in_process):
+            await asyncio.sleep(0.01)
+
+
+async def fetch_clinical_query_part(matchengine: MatchEngine,
+                                    query_node: QueryNode,
+                                    query_part: QueryPart,
+                                    clinical_ids: Set[ClinicalID]):
+    """
+    Execute a single clinical query part for all given clinical IDs which have not already been queried (or are
+    being queried by another worker) with an identical query part, and save the returned IDs on the cache.
+    """
+    query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_node.query_level]
+    collection = query_level_mappings["query_collection"]
+    join_field = query_level_mappings["join_field"]
+    id_field = query_level_mappings["id_field"]
+
+    # hash the inner query to use as a reference for returned clinical ids
+    query_hash = query_part.hash()
+    if query_hash not in matchengine.cache.ids:
+        matchengine.cache.ids[query_hash] = dict()
+
+    # create a nested id_cache where the key is the clinical ID being queried and the vals
+    # are the clinical IDs returned
+    id_cache = matchengine.cache.ids[query_hash]
+    still_waiting_for = matchengine.cache.in_process.setdefault(query_hash, set())
+    need_new = {
+        clinical_id
+        for clinical_id in clinical_ids
+        if clinical_id not in id_cache and clinical_id not in still_waiting_for
+    }
+    if not need_new:
+        return
+    still_waiting_for.update(need_new)
+
+    new_query = {'$and': [{join_field: {'$in': list(need_new)}}, query_part.query]}
+    if matchengine.debug:
+        log.info(f"{query_part.query}")
+    projection = matchengine.match_criteria_transform.id_projections[query_node.query_level]
+    try:
+        cursor = matchengine.async_db_ro[collection].find(new_query, projection).batch_size(ID_QUERY_BATCH_SIZE)
+
+        # save returned ids
+        async for doc in cursor:
+            id_cache[doc[id_field]] = doc[join_field]
+
+        # save IDs NOT returned as None so if a query is run in the future which is the same, it will skip.
+        # updating from a dict lets the id_cache resize once for all of them
+        id_cache.update(dict.fromkeys(need_new.difference(id_cache)))
+    finally:
+        # release the ids even if the query failed, so that they can be fetched again rather than waited on forever
+        still_waiting_for.difference_update(need_new)
+
+
+async def fetch_extended_query_node(matchengine: MatchEngine,
+                                    query_node: QueryNode,
+                                    clinical_ids: Set[ClinicalID]):
+    """
+    Execute the raw query of an extended attributes query node for all given clinical IDs which have not already been
+    queried (or are being queried by another worker) with an identical query, and save the returned extended attribute
+    IDs on the cache.
+    """
+    query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_node.query_level]
+    collection = query_level_mappings["query_collection"]
+    join_field = query_level_mappings["join_field"]
+    id_field = query_level_mappings["id_field"]
+
+    # Create a nested id_cache where the key is the clinical ID being queried and the vals
+    # are the extended_attributes IDs returned
+    query_hash = query_node.raw_query_hash()
+    if query_hash not in matchengine.cache.ids:
+        matchengine.cache.ids[query_hash] = dict()
+    id_cache = matchengine.cache.ids[query_hash]
+    still_waiting_for = matchengine.cache.in_process.setdefault(query_hash, set())
+    need_new = {
+        clinical_id
+        for clinical_id in clinical_ids
+        if clinical_id not in id_cache and clinical_id not in still_waiting_for
+    }
+    if not need_new:
+        return
+    still_waiting_for.update(need_new)
+
+    # the raw query is cached on the query node (which may be shared between tasks), so don't modify it
+    query = query_node.extract_raw_query()
+    new_query = dict(query)
+    new_query['$and'] = [{join_field: {'$in': list(need_new)}}] + query.get('$and', list())
+
+    projection = matchengine.match_criteria_transform.id_projections[query_node.query_level]
+    try:
+        cursor = matchengine.async_db_ro[collection].find(new_query, projection).batch_size(ID_QUERY_BATCH_SIZE)
+        returned_docs = 0
+        async for genomic_doc in cursor:
+            returned_docs += 1
+            # If the clinical id of a returned extended_attributes doc is not present in the cache, add it.
+            returned_clinical_id = genomic_doc[join_field]
+            returned_ids = id_cache.get(returned_clinical_id)
+            if returned_ids is None:
+                id_cache[returned_clinical_id] = {genomic_doc[id_field]}
+            else:
+                returned_ids.add(genomic_doc[id_field])
+        if matchengine.debug:
+            log.info(f"{new_query} returned {returned_docs} documents")
+
+        # Clinical IDs which do not return extended_attributes docs need to be recorded to cache exclusions
+        id_cache.update(dict.fromkeys(need_new.difference(id_cache)))
+    finally:
+        # release the ids even if the query failed, so that they can be fetched again rather than waited on forever
+        still_waiting_for.difference_update(need_new)
+
+
 async def execute_extended_queries(
         matchengine: MatchEngine,
         multi_collection_query: MultiCollectionQuery,
@@ -136,10 +282,6 @@ async def execute_extended_queries(
         if not query_node_container.query_nodes:
             continue
         for qn_idx, query_node in enumerate(query_node_container.query_nodes):
-            query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_node.query_level]
-            collection = query_level_mappings["query_collection"]
-            join_field = query_level_mappings["join_field"]
-            id_field = query_level_mappings["id_field"]
             query_node_container_clinical_ids.append(
                 matchengine.extended_query_node_clinical_ids_subsetter(query_node, clinical_ids.keys())
             )
@@ -147,47 +289,16 @@ async def execute_extended_queries(
             if not working_clinical_ids:
                 continue
 
-            # Create a nested id_cache where the key is the clinical ID being queried and the vals
-            # are the extended_attributes IDs returned
-            query_hash = query_node.raw_query_hash()
-            if query_hash not in matchengine.cache.ids:
-                matchengine.cache.ids[query_hash] = dict()
-            id_cache = matchengine.cache.ids[query_hash]
-            queried_ids = set(id_cache.keys())
-            still_waiting_for = matchengine.cache.in_process.setdefault(query_hash, set())
-            need_new = working_clinical_ids - queried_ids - still_waiting_for
-            matchengine.cache.in_process.setdefault(query_hash, set()).update(need_new)
-            query = query_node.extract_raw_query()
-
-            if need_new:
-                new_query = query
-                new_query['$and'] = new_query.get('$and', list())
-                new_query['$and'].insert(0, {join_field: {'$in': list(need_new)}})
-
-                projection = {id_field: 1, join_field: 1}
-                genomic_docs = await matchengine.async_db_ro[collection].find(new_query, projection).to_list(None)
-                if matchengine.debug:
-                    log.info(f"{new_query} returned {genomic_docs}")
-
-                for genomic_doc in genomic_docs:
-                    # If the clinical id of a returned extended_attributes doc is not present in the cache, add it.
-                    if genomic_doc[join_field] not in id_cache:
-                        id_cache[genomic_doc[join_field]] = set()
-                    id_cache[genomic_doc[join_field]].add(genomic_doc[id_field])
-
-                # Clinical IDs which do not return extended_attributes docs need to be recorded to cache exclusions
-                for unfound in need_new - set(id_cache.keys()):
-                    id_cache[unfound] = None
-                matchengine.cache.in_process[query_hash].difference_update(need_new)
-            while True:
-                still_waiting_for.intersection_update(matchengine.cache.in_process[query_hash])
-                if not still_waiting_for:
-                    break
-                await asyncio.sleep(0.01)
+            id_cache = await fetch_query_ids(
+                matchengine,
+                query_node.raw_query_hash(),
+                working_clinical_ids,
+                lambda: fetch_extended_query_node(matchengine, query_node, working_clinical_ids)
+            )
+            # only the ids being worked on matter here; the id_cache holds every id ever queried with this query
             returned_clinical_ids = {clinical_id
-                                     for clinical_id, genomic_docs
-                                     in id_cache.items()
-                                     if genomic_docs is not None}
+                                     for clinical_id in working_clinical_ids
+                                     if id_cache.get(clinical_id) is not None}
             not_returned_clinical_ids = working_clinical_ids - returned_clinical_ids
             working_clinical_ids.intersection_update((
                 not_returned_clinical_ids
@@ -251,11 +362,14 @@ async def get_docs_results(matchengine: MatchEngine, needed_clinical, needed_ext
     :param needed_extended:
     :return:
     """
-    clinical_projection = matchengine.match_criteria_transform.projections["clinical"]
-    clinical_query = MongoQuery({"_id": {"$in": list(needed_clinical)}})
     db_calls = list()
-    db_calls.append(perform_db_call(matchengine, "clinical", clinical_query, clinical_projection))
+    if needed_clinical:
+        clinical_projection = matchengine.match_criteria_transform.projections["clinical"]
+        clinical_query = MongoQuery({"_id": {"$in": list(needed_clinical)}})
+        db_calls.append(perform_db_call(matchengine, "clinical", clinical_query, clinical_projection))
     for extended_collection, extended_ids in needed_extended.items():
+        if not extended_ids:
+            continue
         genomic_query = MongoQuery({"_id": {"$in": list(extended_ids)}})
         projection = matchengine.match_criteria_transform.projections[extended_collection]
         db_calls.append(perform_db_call(matchengine, extended_collection, genomic_query, projection))
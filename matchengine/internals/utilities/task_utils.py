@@ -3,7 +3,6 @@ from __future__ import annotations
 import asyncio
 import logging
 import traceback
-from collections import defaultdict
 from typing import TYPE_CHECKING, List, Dict
 
 from pymongo import InsertOne
@@ -16,9 +15,10 @@ from matchengine.internals.utilities.list_utils import chunk_list
 from matchengine.internals.typing.matchengine_types import (
     TrialMatch, IndexUpdateTask,
     MatchReason, UpdateTask,
-    RunLogUpdateTask, ClinicalID
+    RunLogUpdateTask, ClinicalID,
+    QueryTask, Task
 )
-from matchengine.internals.utilities.object_comparison import nested_object_hash
+from matchengine.internals.utilities.object_comparison import nested_object_hashes
 from matchengine.internals.utilities.utilities import get_sort_order
 
 if TYPE_CHECKING:
@@ -27,6 +27,23 @@ if TYPE_CHECKING:
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('matchengine')
 
+# errors which are likely to go away if a task is tried again, and how many times a task is retried on them
+TRANSIENT_ERRORS = {AutoReconnect, CursorNotFound, ServerSelectionTimeoutError}
+MAX_TASK_RETRIES = 3
+
+
+def retry_or_drop_task(matchengine: MatchEngine, task: Task, worker_id):
+    """
+    Put a task which failed with a transient error back on the queue, unless it has already been retried
+    MAX_TASK_RETRIES times, in which case it is dropped. Either way, the failed attempt is marked as done.
+    """
+    if task.retries < MAX_TASK_RETRIES:
+        task.retries += 1
+        matchengine.task_q.put_nowait(task)
+    else:
+        log.error(f"ERROR: Worker: {worker_id}, dropping {task.__class__.__name__} after {task.retries} retries")
+    matchengine.task_q.task_done()
+
 
 async def run_check_indices_task(matchengine: MatchEngine, task, worker_id):
     """
@@ -52,15 +69,8 @@ async def run_check_indices_task(matchengine: MatchEngine, task, worker_id):
     except Exception as e:
         log.error(f"ERROR: Worker: {worker_id}, error: {e}")
         log.error(f"TRACEBACK: {traceback.print_tb(e.__traceback__)}")
-        if e.__class__ is AutoReconnect:
-            await matchengine.task_q.put(task)
-            matchengine.task_q.task_done()
-        elif e.__class__ is CursorNotFound:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
-        elif e.__class__ is ServerSelectionTimeoutError:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
+        if e.__class__ in TRANSIENT_ERRORS:
+            retry_or_drop_task(matchengine, task, worker_id)
         else:
             matchengine.__exit__(None, None, None)
             matchengine.loop.stop()
@@ -79,15 +89,8 @@ async def run_index_update_task(matchengine: MatchEngine, task: IndexUpdateTask,
     except Exception as e:
         log.error(f"ERROR: Worker: {worker_id}, error: {e}")
         log.error(f"TRACEBACK: {traceback.print_tb(e.__traceback__)}")
-        if e.__class__ is AutoReconnect:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
-        elif e.__class__ is CursorNotFound:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
-        elif e.__class__ is ServerSelectionTimeoutError:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
+        if e.__class__ in TRANSIENT_ERRORS:
+            retry_or_drop_task(matchengine, task, worker_id)
         else:
             matchengine.loop.stop()
             log.error((f"ERROR: Worker: {worker_id}, error: {e}"
@@ -106,25 +109,21 @@ async def run_query_task(matchengine: MatchEngine, task, worker_id):
         results = dict()
         log.error(f"ERROR: Worker: {worker_id}, error: {e}")
         log.error(f"TRACEBACK: {traceback.print_tb(e.__traceback__)}")
-        if e.__class__ is AutoReconnect:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
-        elif e.__class__ is CursorNotFound:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
-        elif e.__class__ is ServerSelectionTimeoutError:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
+        if e.__class__ in TRANSIENT_ERRORS:
+            # the task is either back on the queue or has been dropped; either way this attempt is done
+            retry_or_drop_task(matchengine, task, worker_id)
+            return
         else:
             matchengine.loop.stop()
             log.error(f"ERROR: Worker: {worker_id}, error: {e}")
             log.error(f"TRACEBACK: {traceback.print_tb(e.__traceback__)}")
 
     try:
-        by_sample_id = defaultdict(list)
         matchengine.results_transformer(results)
         if not results:
             matchengine.matches.setdefault(task.match_clause_data.protocol_no, dict())
+        trial_match_base = None
+        match_documents = list()
         for _, sample_results in results.items():
             for result in sample_results:
                 matchengine.queue_task_count += 1
@@ -140,18 +139,22 @@ async def run_query_task(matchengine: MatchEngine, task, worker_id):
                 # allow user to extend trial_match objects in plugin functions
                 # generate required fields on trial match doc before
                 # generate sort_order and hash fields after all fields are added
-                new_match_proto = matchengine.pre_process_trial_matches(match_context_data)
+                if trial_match_base is None:
+                    trial_match_base = matchengine.get_trial_match_base(match_context_data)
+                new_match_proto = matchengine.pre_process_trial_matches(match_context_data, trial_match_base)
                 match_document = matchengine.create_trial_matches(match_context_data, new_match_proto)
                 sort_order = get_sort_order(matchengine, match_document)
                 match_document['sort_order'] = sort_order
-                to_hash = {key: match_document[key] for key in match_document if key not in {'hash', 'is_disabled'}}
-                match_document['hash'] = nested_object_hash(to_hash)
-                match_document['_me_id'] = matchengine.run_id.hex
+                match_documents.append(match_document)
 
-                matchengine.matches.setdefault(task.trial[trial_identifier],
-                                               dict()).setdefault(match_document['sample_id'],
-                                                                  list()).append(match_document)
-                by_sample_id[match_document['sample_id']].append(match_document)
+                # match documents are created as each query's results arrive; hash and save them in chunks,
+                # handing the loop back to the other workers in between so a large result set doesn't hold up
+                # their queries
+                if len(match_documents) >= matchengine.chunk_size:
+                    await save_match_documents(matchengine, task, match_documents)
+                    match_documents = list()
+        if match_documents:
+            await save_match_documents(matchengine, task, match_documents)
 
     except Exception as e:
         matchengine.loop.stop()
@@ -162,6 +165,27 @@ async def run_query_task(matchengine: MatchEngine, task, worker_id):
     matchengine.task_q.task_done()
 
 
+async def save_match_documents(matchengine: MatchEngine, task: QueryTask, match_documents: List[Dict]):
+    """
+    Add hashes to newly created match documents, and save them on the matchengine.
+    If the matchengine has a hash pool, hashing is done there, otherwise it is done in-process.
+    """
+    to_hash = [{key: match_document[key] for key in match_document if key not in {'hash', 'is_disabled'}}
+               for match_document in match_documents]
+    if matchengine.hash_pool is None:
+        hashes = nested_object_hashes(to_hash)
+        await asyncio.sleep(0)
+    else:
+        hashes = await matchengine.loop.run_in_executor(matchengine.hash_pool, nested_object_hashes, to_hash)
+
+    trial_identifier = matchengine.match_criteria_transform.trial_identifier
+    matches_by_sample_id = matchengine.matches.setdefault(task.trial[trial_identifier], dict())
+    for match_document, match_hash in zip(match_documents, hashes):
+        match_document['hash'] = match_hash
+        match_document['_me_id'] = matchengine.run_id.hex
+        matches_by_sample_id.setdefault(match_document['sample_id'], list()).append(match_document)
+
+
 async def run_poison_pill(matchengine: MatchEngine, task, worker_id):
     if matchengine.debug:
         log.info(f"Worker: {worker_id} got PoisonPill")
@@ -183,15 +207,8 @@ async def run_update_task(matchengine: MatchEngine, task: UpdateTask, worker_id)
     except Exception as e:
         log.error(f"ERROR: Worker: {worker_id}, error: {e}")
         log.error(f"TRACEBACK: {traceback.print_tb(e.__traceback__)}")
-        if e.__class__ is AutoReconnect:
-            matchengine.task_q.task_done()
-            matchengine.task_q.put_nowait(task)
-        elif e.__class__ is CursorNotFound:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
-        elif e.__class__ is ServerSelectionTimeoutError:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
+        if e.__class__ in TRANSIENT_ERRORS:
+            retry_or_drop_task(matchengine, task, worker_id)
         else:
             raise e
 
@@ -229,14 +246,7 @@ async def run_run_log_update_task(matchengine: MatchEngine, task: RunLogUpdateTa
     except Exception as e:
         log.error(f"ERROR: Worker: {worker_id}, error: {e}")
         log.error(f"TRACEBACK: {traceback.print_tb(e.__traceback__)}")
-        if e.__class__ is AutoReconnect:
-            matchengine.task_q.task_done()
-            matchengine.task_q.put_nowait(task)
-        elif e.__class__ is CursorNotFound:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
-        elif e.__class__ is ServerSelectionTimeoutError:
-            matchengine.task_q.put_nowait(task)
-            matchengine.task_q.task_done()
+        if e.__class__ in TRANSIENT_ERRORS:
+            retry_or_drop_task(matchengine, task, worker_id)
         else:
             raise e
@@ -55,23 +55,27 @@ async def async_update_matches_by_protocol_no(matchengine: MatchEngine, protocol
             delete_ops = await get_delete_ops(matches_to_disable, matchengine)
             matchengine.task_q.put_nowait(UpdateTask(delete_ops, protocol_no))
 
+    if not matchengine.drop:
+        # look up existing matches for the whole protocol up front, rather than issuing two queries per sample
+        all_new_matches_hashes = [match['hash'] for matches in matches_by_sample_id.values() for match in matches]
+        existing = await get_existing_matches(matchengine, all_new_matches_hashes)
+        existing_hashes = {result['hash'] for result in existing}
+        disabled = {result['hash'] for result in existing if result['is_disabled']}
+        enabled_matches_by_sample_id = await get_enabled_matches_by_sample_id(matchengine,
+                                                                              protocol_no,
+                                                                              list(matches_by_sample_id.keys()))
+
     for sample_id in matches_by_sample_id.keys():
         if not matchengine.drop:
-            new_matches_hashes = [match['hash'] for match in matches_by_sample_id[sample_id]]
-
-            # get existing matches in db with identical hashes to newly found matches
-            existing = await get_existing_matches(matchengine, new_matches_hashes)
-            existing_hashes = {result['hash'] for result in existing}
-            disabled = {result['hash'] for result in existing if result['is_disabled']}
+            new_matches_hashes = {match['hash'] for match in matches_by_sample_id[sample_id]}
 
             # insert new matches if they don't already exist. disable everything else
             matches_to_insert = get_matches_to_insert(matches_by_sample_id,
                                                       existing_hashes,
                                                       sample_id)
-            matches_to_disable = await get_matches_to_disable(matchengine,
-                                                              new_matches_hashes,
-                                                              protocol_no,
-                                                              sample_id)
+            matches_to_disable = [match
+                                  for match in enabled_matches_by_sample_id.get(sample_id, list())
+                                  if match['hash'] not in new_matches_hashes]
 
             # flip is_disabled flag if a new match generated during run matches hash of an existing
             matches_to_mark_available = [m for m in matches_by_sample_id[sample_id] if
@@ -141,50 +145,44 @@ async def get_existing_matches(matchengine: MatchEngine, new_matches_hashes: lis
     :param new_matches_hashes:
     :return:
     """
-    matches_to_not_change_query = MongoQuery({'hash': {'$in': new_matches_hashes}})
     projection = {"hash": 1, "is_disabled": 1}
-    matches = await asyncio.gather(
+    results = await asyncio.gather(*[
         perform_db_call(matchengine,
                         matchengine.trial_match_collection,
-                        matches_to_not_change_query,
+                        MongoQuery({'hash': {'$in': chunk}}),
                         projection)
-    )
-    return matches[0]
+        for chunk in chunk_list(new_matches_hashes, matchengine.chunk_size)
+    ])
+    return [match for chunk_results in results for match in chunk_results]
 
 
-async def get_matches_to_disable(matchengine: MatchEngine,
-                                 new_matches_hashes: list,
-                                 protocol_no: str,
-                                 sample_id: str) -> list:
+async def get_enabled_matches_by_sample_id(matchengine: MatchEngine,
+                                           protocol_no: str,
+                                           sample_ids: list) -> dict:
     """
-    Get matches to disable by looking for existing, enabled matches whose
-    hashes are not present in newly generated matches during current run.
-
-    Done for every sample_id
+    Get existing, enabled matches for a protocol, grouped by sample id.
+    Any of these whose hashes are not present in the newly generated matches for that sample should be disabled.
 
     :param matchengine:
-    :param new_matches_hashes:
     :param protocol_no:
-    :param sample_id:
+    :param sample_ids:
     :return:
     """
-    query = {
-        matchengine.match_criteria_transform.match_trial_link_id: protocol_no,
-        'sample_id': sample_id,
-        'is_disabled': False,
-        'hash': {
-            '$nin': new_matches_hashes
-        }
-    }
-    matches_to_disable_query = MongoQuery(query)
-    projection = {"hash": 1, "is_disabled": 1}
-    matches = await asyncio.gather(
+    projection = {"hash": 1, "is_disabled": 1, "sample_id": 1}
+    results = await asyncio.gather(*[
         perform_db_call(matchengine,
                         matchengine.trial_match_collection,
-                        matches_to_disable_query,
+                        MongoQuery({matchengine.match_criteria_transform.match_trial_link_id: protocol_no,
+                                    'sample_id': {'$in': chunk},
+                                    'is_disabled': False}),
                         projection)
-    )
-    return matches[0]
+        for chunk in chunk_list(sample_ids, matchengine.chunk_size)
+    ])
+    matches_by_sample_id = dict()
+    for chunk_results in results:
+        for match in chunk_results:
+            matches_by_sample_id.setdefault(match['sample_id'], list()).append(match)
+    return matches_by_sample_id
 
 
 def get_update_operations(matches_to_disable: list,
@@ -157,21 +157,17 @@ def get_sort_order(matchengine: MatchEngine, match_document: Dict) -> list:
     15. All other Coordinating centers
     16. Protocol Number
     """
-    sort_map = matchengine.config['trial_match_sorting']
     sort_array = list()
 
-    for sort_dimension in sort_map:
+    for sort_dimension in matchengine.match_criteria_transform.trial_match_sorting:
         sort_index = 99
-        for sort_key in sort_dimension:
+        for sort_key, sorting_vals, any_value_sort_int in sort_dimension:
             if sort_key in match_document:
-                sorting_vals = sort_dimension[sort_key]
-                is_any = sorting_vals.get("ANY_VALUE", None)
-                trial_match_val = str(match_document[sort_key]) if is_any is None else "ANY_VALUE"
-
-                if (trial_match_val is not None and trial_match_val in sorting_vals) or is_any is not None:
-                    matched_sort_int = sort_dimension[sort_key][trial_match_val]
-                    if matched_sort_int < sort_index:
-                        sort_index = matched_sort_int
+                matched_sort_int = (any_value_sort_int
+                                    if any_value_sort_int is not None
+                                    else sorting_vals.get(str(match_document[sort_key]), None))
+                if matched_sort_int is not None and matched_sort_int < sort_index:
+                    sort_index = matched_sort_int
 
         sort_array.append(sort_index)
 
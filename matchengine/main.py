@@ -1,9 +1,15 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
 import os
 from multiprocessing import cpu_count
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from matchengine.internals.engine import MatchEngine
 from matchengine.internals.load import load
 
@@ -12,6 +18,10 @@ def main(run_args):
     """
     Main function which triggers run of engine with args passed in from command line.
     """
+    # the engine creates its own event loop; if uvloop is installed, have that loop be a libuv-backed one,
+    # which cuts the per-await overhead of the queue workers (which do very little work between awaits)
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     with MatchEngine(
             plugin_dir=run_args.plugin_dir,
             sample_ids=run_args.samples,
@@ -32,7 +42,8 @@ def main(run_args):
             drop_accept=run_args.confirm_drop,
             exit_after_drop=run_args.drop_and_exit,
             resource_dirs=run_args.extra_resource_dirs,
-            bypass_warnings=run_args.bypass_warnings
+            bypass_warnings=run_args.bypass_warnings,
+            hash_workers=run_args.hash_workers
     ) as me:
         me.get_matches_for_all_trials()
         if not args.dry:
@@ -123,6 +134,8 @@ if __name__ == "__main__":
     subp_p.add_argument("--bypass-warnings", dest="bypass_warnings", action="store_true", default=False,
                         help="Bypass warnings")
     subp_p.add_argument("--workers", nargs=1, type=int, default=[cpu_count() * 5])
+    subp_p.add_argument("--hash-workers", dest="hash_workers", type=int, default=0,
+                        help="Number of processes to use for hashing match documents. Default is to hash in-process.")
     subp_p.add_argument('--db', dest='db_name', default=None, required=False, help=db_name_help)
     subp_p.add_argument('--o', dest="csv_output", action="store_true", default=False, required=False,
                         help=csv_output_help)
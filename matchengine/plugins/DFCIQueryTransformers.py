@@ -24,15 +24,15 @@ class DFCIQueryTransformers(QueryTransformerContainer):
         numeric = "".join([i for i in trial_value if i.isdigit() or i == '.'])
         if numeric.startswith('.'):
             numeric = '0' + numeric
-        return QueryTransformerResult({sample_key: {operator_map[operator]: float(numeric)}}, False)
+        return QueryTransformerResult.of({sample_key: {operator_map[operator]: float(numeric)}}, False)
 
     def bool_from_text(self, **kwargs):
         trial_value = kwargs['trial_value']
         sample_key = kwargs['sample_key']
         if trial_value.upper() == 'TRUE':
-            return QueryTransformerResult({sample_key: True}, False)
+            return QueryTransformerResult.of({sample_key: True}, False)
         elif trial_value.upper() == 'FALSE':
-            return QueryTransformerResult({sample_key: False}, False)
+            return QueryTransformerResult.of({sample_key: False}, False)
 
     def cnv_map(self, **kwargs):
         # Heterozygous deletion,
@@ -53,9 +53,9 @@ class DFCIQueryTransformers(QueryTransformerContainer):
 
         trial_value, negate = self.transform.is_negate(trial_value)
         if trial_value in cnv_map:
-            return QueryTransformerResult({sample_key: cnv_map[trial_value]}, negate)
+            return QueryTransformerResult.of({sample_key: cnv_map[trial_value]}, negate)
         else:
-            return QueryTransformerResult({sample_key: trial_value}, negate)
+            return QueryTransformerResult.of({sample_key: trial_value}, negate)
 
     def variant_category_map(self, **kwargs):
         trial_value = kwargs['trial_value']
@@ -72,14 +72,14 @@ class DFCIQueryTransformers(QueryTransformerContainer):
         # STRUCTURAL_VARIANT_COMMENT for mention of the TRUE_HUGO_SYMBOL
         if trial_value == 'Structural Variation':
             sample_value = variant_category_map.get(trial_value.lower())
-            results = QueryTransformerResult()
+            results = QueryTransformerResult.empty()
             results.add_result({'STRUCTURAL_VARIANT_COMMENT': None}, negate)
             results.add_result({'STRUCTURED_SV': None, sample_key: sample_value}, negate)
             return results
         elif trial_value.lower() in variant_category_map:
-            return QueryTransformerResult({sample_key: variant_category_map[trial_value.lower()]}, negate)
+            return QueryTransformerResult.of({sample_key: variant_category_map[trial_value.lower()]}, negate)
         else:
-            return QueryTransformerResult({sample_key: trial_value.upper()}, negate)
+            return QueryTransformerResult.of({sample_key: trial_value.upper()}, negate)
 
     def wildcard_regex(self, **kwargs):
         """
@@ -104,8 +104,8 @@ class DFCIQueryTransformers(QueryTransformerContainer):
         if not trial_value.startswith('p.'):
             trial_value = re.escape('p.' + trial_value)
         trial_value = f'^{trial_value}[ACDEFGHIKLMNPQRSTVWY]$'
-        return QueryTransformerResult({kwargs['sample_key']: {'$regex': re.compile(trial_value, re.IGNORECASE)}},
-                                      negate)
+        return QueryTransformerResult.of({kwargs['sample_key']: {'$regex': re.compile(trial_value, re.IGNORECASE)}},
+                                         negate)
 
     def mmr_ms_map(self, **kwargs):
         mmr_map = {
@@ -119,7 +119,7 @@ class DFCIQueryTransformers(QueryTransformerContainer):
         trial_value, negate = self.transform.is_negate(trial_value)
         sample_key = kwargs['sample_key']
         sample_value = mmr_map[trial_value]
-        return QueryTransformerResult({sample_key: sample_value}, negate)
+        return QueryTransformerResult.of({sample_key: sample_value}, negate)
 
 
 __export__ = ["DFCIQueryTransformers"]
@@ -126,7 +126,8 @@ def get_clinical_details(clinical_doc, query):
     if all((q_tmb, c_tmb)):
         alteration.append(f"TMB = {c_tmb}")
         match_type = "tmb"
-        clinical_doc.update({'variant_category': 'TMB'})
+        # clinical_doc is the cached document, shared with every other match for this patient
+        clinical_doc = dict(clinical_doc, variant_category='TMB')
     else:
         match_type = "generic_clinical"
 
@@ -147,7 +148,7 @@ def format_exclusion_match(trial_match: TrialMatch):
     variant_classification = 'TRUE_VARIANT_CLASSIFICATION'
     sv_comment = 'STRUCTURAL_VARIANT_COMMENT'
     alteration = ['!']
-    is_variant = 'variant' if query.setdefault(protein_change_key, None) is not None else 'gene'
+    is_variant = 'variant' if query.get(protein_change_key, None) is not None else 'gene'
 
     true_hugo_symbol_added = False
     if true_hugo in query and query[true_hugo] is not None:
@@ -237,7 +238,7 @@ class DFCITrialMatchDocumentCreator(TrialMatchDocumentCreator):
         new_trial_match.update({'cancer_type_match': get_cancer_type_match(trial_match)})
 
         if trial_match.match_reason.reason_name == 'genomic':
-            genomic_doc = self.cache.docs.setdefault(trial_match.match_reason.reference_id, None)
+            genomic_doc = self.cache.docs.get(trial_match.match_reason.reference_id, None)
             if genomic_doc is None:
                 new_trial_match.update(format_trial_match_k_v(format_exclusion_match(trial_match)))
             else:
@@ -1,18 +1,74 @@
+import asyncio
+import copy
 import glob
 import json
 import os
+from functools import partial
 from unittest import TestCase
 
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+
 from matchengine.internals.engine import MatchEngine
 from matchengine.internals.match_criteria_transform import MatchCriteriaTransform
 from matchengine.internals.match_translator import create_match_tree, get_match_paths, extract_match_clauses_from_trial, \
-    translate_match_path
+    translate_match_path, run_query_transformer
 from matchengine.internals.typing.matchengine_types import MatchClause, MatchCriteria, MatchCriterion
 from matchengine.internals.typing.matchengine_types import MatchClauseData, ParentPath, MatchClauseLevel
-from matchengine.internals.utilities.object_comparison import nested_object_hash
+from matchengine.internals.typing.matchengine_types import (
+    Cache,
+    MultiCollectionQuery,
+    QueryNode,
+    QueryNodeContainer,
+    QueryPart,
+    QueryTask,
+    QueryTransformerResult
+)
+from matchengine.internals.utilities.object_comparison import (
+    hash_object_strings,
+    nested_object_hash,
+    nested_object_hashes,
+    nested_object_strings
+)
+from matchengine.internals.utilities.query import execute_clinical_queries
+from matchengine.internals.utilities.task_utils import retry_or_drop_task
 from matchengine.internals.utilities.utilities import find_plugins
 
 
+class FlakyCursor(object):
+    """Stands in for a motor cursor, optionally losing its connection after the first document"""
+
+    def __init__(self, docs, fail):
+        self.docs = docs
+        self.fail = fail
+
+    def batch_size(self, _):
+        return self
+
+    async def _iterate(self):
+        for doc in self.docs:
+            await asyncio.sleep(0)
+            if self.fail:
+                raise AutoReconnect("connection lost")
+            yield doc
+
+    def __aiter__(self):
+        return self._iterate()
+
+
+class FlakyCollection(object):
+    """Stands in for a motor collection of clinical documents, the first query on which fails"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = 0
+
+    def find(self, query, _):
+        self.queries += 1
+        queried_ids = set(query['$and'][0]['_id']['$in'])
+        return FlakyCursor([doc for doc in self.docs if doc['_id'] in queried_ids], self.queries == 1)
+
+
 class TestMatchEngine(TestCase):
 
     def setUp(self) -> None:
@@ -87,6 +143,33 @@ class TestMatchEngine(TestCase):
         assert len(to_upper_ret) == 1 and not to_upper_no_negate
         assert 'test' in ext_f_map_ret and to_upper_ret['test'] == 'TEST'
 
+    def test_query_transformer_result_constructors(self):
+        def parts(query_transformer_result):
+            return [(query_part.__class__, query_part.query, query_part.negate, query_part.render,
+                     query_part.mcq_invalidating)
+                    for query_part in query_transformer_result.results]
+
+        empty = QueryTransformerResult.empty()
+        assert empty.results.__class__ is list and parts(empty) == parts(QueryTransformerResult())
+        empty.add_result({'test': 'value'}, True)
+        added = QueryTransformerResult()
+        added.add_result({'test': 'value'}, True)
+        assert parts(empty) == parts(added)
+
+        for args in [({'test': 'value'}, False),
+                     ({'test': 'value'}, True),
+                     ({'test': {'$in': ['a', 'b']}}, True, False),
+                     ({'test': 'value'}, False, False, True)]:
+            of = QueryTransformerResult.of(*args)
+            assert of.results.__class__ is list
+            assert parts(of) == parts(QueryTransformerResult(*args))
+            added = QueryTransformerResult.empty()
+            added.add_result(*args)
+            assert parts(of) == parts(added)
+            # more parts can be added to either
+            of.add_result({'other': 'value'}, False, False)
+            assert len(of.results) == 2 and not of.results[1].render
+
     def test_extract_match_clauses_from_trial(self):
         self.me.trials = dict()
         self.me.match_on_closed = False
@@ -169,6 +252,34 @@ class TestMatchEngine(TestCase):
                         assert nested_object_hash(inner_test_case_criteria) == nested_object_hash(
                             inner_match_path_criteria)
 
+    def test_match_criterion_hash(self):
+        """MatchCriterion hashes are persisted as the query_hash of trial matches, so must not change"""
+        match_criterion = MatchCriterion([
+            MatchCriteria([{'genomic': {'hugo_symbol': 'BRAF', 'protein_change': 'p.V600E'}}], 1, 1),
+            MatchCriteria([{'clinical': {'age_numerical': '>=18', 'oncotree_primary_diagnosis': '_SOLID_'}},
+                           {'genomic': {'hugo_symbol': 'KRAS'}}], 2, 3)
+        ])
+        assert match_criterion.hash() == '5594c029a5ccd0727adeba19ae75735c1168eae2'
+        assert MatchCriterion(list()).hash() == nested_object_hash({'query': list()})
+
+        # criteria are shared between the paths of a match tree, which must hash as if they weren't
+        for file in glob.glob('./matchengine/tests/data/ctml_boolean_cases/*.json'):
+            with open(file) as f:
+                match_clause = [json.load(f)]
+            match_tree = create_match_tree(self.me, MatchClauseData(match_clause=match_clause,
+                                                                    internal_id='123',
+                                                                    code='456',
+                                                                    coordinating_center='The Death Star',
+                                                                    status='Open to Accrual',
+                                                                    parent_path=ParentPath(()),
+                                                                    match_clause_level=MatchClauseLevel('arm'),
+                                                                    match_clause_additional_attributes={},
+                                                                    is_suspended=True,
+                                                                    protocol_no='12-345'))
+            for match_path in get_match_paths(match_tree):
+                assert match_path.hash() == nested_object_hash(
+                    {'query': [criteria.criteria for criteria in match_path.criteria_list]})
+
     def test_translate_match_path(self):
         self.me.trials = dict()
         find_plugins(self.me)
@@ -187,6 +298,50 @@ class TestMatchEngine(TestCase):
         assert len(match_paths.clinical) == 0
         assert len(match_paths.extended_attributes) == 0
 
+    def test_run_query_transformer_memoization(self):
+        """Results are memoized, so mutating a returned query part must not change those returned for later criteria"""
+        find_plugins(self.me)
+        sample_function = partial(self.me.match_criteria_transform.query_transformers.external_file_mapping,
+                                  sample_key='test',
+                                  trial_path='test',
+                                  trial_key='test',
+                                  file='external_file_mapping_test.json')
+        first_result = run_query_transformer(self.me, sample_function, 'test', 'test', 'test', ParentPath(()))
+        first_part = first_result.results[0]
+        expected_query = copy.deepcopy(first_part.query)
+        expected_hash = first_part.hash()
+        assert expected_hash == nested_object_hash(expected_query)
+
+        first_part.set_query_attr('test', {'$in': ['option_5']})
+        first_part.render = False
+        second_result = run_query_transformer(self.me, sample_function, 'test', 'test', 'test', ParentPath(()))
+        second_part = second_result.results[0]
+        assert second_part is not first_part
+        assert second_part.query == expected_query and second_part.render
+        assert second_part.hash() == expected_hash
+
+        # nested values are not shared between results either
+        second_part.query['test']['$in'].append('option_5')
+        third_part = run_query_transformer(self.me, sample_function, 'test', 'test', 'test', ParentPath(())).results[0]
+        assert third_part.query == expected_query
+        assert third_part.hash() == expected_hash == nested_object_hash(third_part.query)
+
+    def test_run_query_transformer_memoization_value_class(self):
+        """Values which are equal but of different classes are not given each other's memoized results"""
+        find_plugins(self.me)
+        sample_function = partial(self.me.match_criteria_transform.query_transformers.nomap,
+                                  sample_key='SOME_FLAG',
+                                  trial_path='clinical',
+                                  trial_key='some_flag')
+        for trial_value in [1, True, 1.0, 1, True, 1.0]:
+            query = run_query_transformer(self.me,
+                                          sample_function,
+                                          'clinical',
+                                          'some_flag',
+                                          trial_value,
+                                          ParentPath(())).results[0].query
+            assert query == {'SOME_FLAG': trial_value} and query['SOME_FLAG'].__class__ is trial_value.__class__
+
     def test_comparable_dict(self):
         assert nested_object_hash({}) == nested_object_hash({})
         assert nested_object_hash({"1": "1",
@@ -219,3 +374,126 @@ class TestMatchEngine(TestCase):
             },
             "4": [9, 8]
         })
+
+    def test_nested_object_strings(self):
+        """Hashing the strings of an object, or a batch of objects, gives the same digests as nested_object_hash"""
+        items = [
+            {},
+            [],
+            {'a': {'b': {'c': 'd'}}},
+            [[1, 2], [3, [4, {5: 6}]]],
+            {'1': [{'set': {1, 2, 3}}, {2: 3}], '2': '2'},
+            {'str': 'value', 'int': 1, 'float': 1.5, 'bool': True, 'none': None, 'unicode': 'M\u00e9n\u00e9trier',
+             'list': [1, 'a', None, {'nested': [{'x': 1.0}, {2, 3}]}], 'object_id': ObjectId('5d2799cb6756630d8dd0653b')}
+        ]
+        for item in items:
+            assert hash_object_strings(nested_object_strings(item)) == nested_object_hash(item)
+        assert nested_object_hashes(items) == [nested_object_hash(item) for item in items]
+        assert nested_object_hashes([items[-1]])[0] == nested_object_hash(items[-1])
+
+        # strings for an object nested in a list can be built separately and combined
+        assert hash_object_strings(nested_object_strings(items[2], ('query', None))
+                                   + nested_object_strings(items[3], ('query', None))) == nested_object_hash(
+            {'query': [items[2], items[3]]})
+
+    def test_nested_object_hash_digest(self):
+        """Digests are persisted on trial matches, so pin them. Non-ASCII values are hashed as UTF-8"""
+        assert nested_object_hash({
+            'TRUE_HUGO_SYMBOL': 'BRAF',
+            'TRUE_PROTEIN_CHANGE': 'p.V600E',
+            'nested': [{'a': 1}, {'b': None}]
+        }) == '9566156cac54334cc7e05029c8d3c003b04ea5ae'
+        assert nested_object_hash({
+            'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 'H\u00fcrthle Cell Thyroid Cancer',
+            'TRUE_HUGO_SYMBOL': 'BRAF',
+            'list': ['Ewing Sarcoma', 'M\u00e9n\u00e9trier']
+        }) == '5e30d461b59f51d178df1907f7e5a7316ac997ba'
+
+    def test_query_node_get_query_part_by_key(self):
+        first_part = QueryPart({'TRUE_HUGO_SYMBOL': 'BRAF', 'TRUE_PROTEIN_CHANGE': 'p.V600E'}, False, True, False)
+        second_part = QueryPart({'TRUE_HUGO_SYMBOL': 'KRAS', 'VARIANT_CATEGORY': 'MUTATION'}, False, True, False)
+        query_node = QueryNode('genomic', 1, {}, 1, [first_part, second_part])
+        for _ in range(2):
+            # the same lookups, before and after the key index is built by finalize
+            assert query_node.get_query_part_by_key('TRUE_HUGO_SYMBOL') is first_part
+            assert query_node.get_query_part_by_key('VARIANT_CATEGORY') is second_part
+            assert query_node.get_query_part_by_key('MISSING') is None
+            assert query_node.get_query_part_value_by_key('TRUE_PROTEIN_CHANGE') == 'p.V600E'
+            assert query_node.get_query_part_value_by_key('MISSING') is None
+            assert query_node.get_query_part_value_by_key('MISSING', 'default') == 'default'
+            query_node.finalize()
+
+        copied_query_node = query_node.__copy__()
+        assert copied_query_node.get_query_part_by_key('TRUE_HUGO_SYMBOL') is copied_query_node.query_parts[0]
+        assert copied_query_node.get_query_part_by_key('VARIANT_CATEGORY') is copied_query_node.query_parts[1]
+
+        # node transformers set query attributes before the node is finalized, which the index reflects
+        query_part = QueryPart({'TRUE_HUGO_SYMBOL': 'BRAF'}, False, True, False)
+        query_node = QueryNode('genomic', 1, {}, 1, [query_part])
+        query_part.set_query_attr('TRUE_HUGO_SYMBOL', 'KRAS')
+        query_part.set_query_attr('TRUE_TRANSCRIPT_EXON', 19)
+        query_node.finalize()
+        assert query_node.get_query_part_value_by_key('TRUE_HUGO_SYMBOL') == 'KRAS'
+        assert query_node.get_query_part_by_key('TRUE_TRANSCRIPT_EXON') is query_part
+
+    def test_query_node_finalize(self):
+        query_node = QueryNode('genomic', 1, {}, 1, list())
+        query_node.add_query_part(QueryPart({'TRUE_HUGO_SYMBOL': 'BRAF'}, False, True, False))
+        query_node.add_query_part(QueryPart({'TRUE_PROTEIN_CHANGE': 'p.V600E'}, False, False, False))
+        query_node.finalize()
+        assert query_node.query_parts.__class__ is tuple
+        assert query_node.extract_raw_query() == {'TRUE_HUGO_SYMBOL': 'BRAF'}
+        with self.assertRaises(Exception):
+            query_node.add_query_part(QueryPart({'VARIANT_CATEGORY': 'MUTATION'}, False, True, False))
+        assert len(query_node.query_parts) == 2
+
+        copied_query_node = query_node.__copy__()
+        assert copied_query_node.is_finalized and copied_query_node.query_parts.__class__ is tuple
+        with self.assertRaises(Exception):
+            copied_query_node.add_query_part(QueryPart({'VARIANT_CATEGORY': 'MUTATION'}, False, True, False))
+
+    def test_query_task_retry(self):
+        """A query task failing part way through a query is retried, and neither it nor a task waiting on the same
+        query hangs"""
+        config = copy.deepcopy(self.config)
+        config['ctml_collection_mappings']['clinical']['id_field'] = '_id'
+        self.me.match_criteria_transform = MatchCriteriaTransform(config,
+                                                                  [os.path.join(os.path.dirname(__file__), 'data')])
+        self.me.cache = Cache()
+        self.me._task_q = asyncio.Queue()
+        clinical_ids = [ObjectId() for _ in range(3)]
+        self.me.async_db_ro = {'clinical': FlakyCollection([{'_id': clinical_id} for clinical_id in clinical_ids[:2]])}
+
+        query_node = QueryNode('clinical', 1, {}, 1, [QueryPart({'GENDER': 'Female'}, False, True, False)])
+        query_node.finalize()
+        multi_collection_query = MultiCollectionQuery(list(), [QueryNodeContainer([query_node])])
+        task = QueryTask(None, None, None, multi_collection_query, set(clinical_ids))
+        query_hash = query_node.query_parts[0].hash()
+
+        async def run_task():
+            try:
+                return await execute_clinical_queries(self.me, task.query, set(task.clinical_ids))
+            except AutoReconnect:
+                retry_or_drop_task(self.me, task, 0)
+
+        async def first_attempt():
+            self.me.task_q.put_nowait(task)
+            await self.me.task_q.get()
+            # another task with the same query waits on the ids being fetched by the failing one
+            return await asyncio.gather(run_task(), execute_clinical_queries(self.me,
+                                                                             multi_collection_query,
+                                                                             set(clinical_ids)))
+
+        loop = asyncio.new_event_loop()
+        try:
+            failed, waiting = loop.run_until_complete(asyncio.wait_for(first_attempt(), 5))
+            assert failed is None and task.retries == 1
+            assert waiting[0] == set(clinical_ids[:2])
+            assert not self.me.cache.in_process[query_hash]
+
+            retried_task = self.me.task_q.get_nowait()
+            assert retried_task is task
+            matched_clinical_ids, _ = loop.run_until_complete(asyncio.wait_for(run_task(), 5))
+            assert matched_clinical_ids == set(clinical_ids[:2])
+        finally:
+            loop.close()
@@ -33,6 +33,9 @@ setup(
         "networkx>=2.3",
         "motor==2.0.0"
     ],
+    extras_require={
+        "uvloop": ["uvloop>=0.12.0"]
+    },
     include_package_data=True,
     python_requires='>=3.7',
     download_url='https://github.com/dfci/matchengine-V2/archive/2.0.0.tar.gz',